@@ -39,10 +39,31 @@ with open(os.path.join(CONFIG_DIR, 'settings.yaml'), 'r') as settings_yaml:
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = ep_config['secrets']['master-key']
 MASTER_SALT = ep_config['secrets']['master-salt']
+# salts being rotated out, each a salt or `{salt, kdf}` when master-kdf changed as well; still accepted for
+# decryption until rotate_masterkey has finished
+MASTER_SALT_PREVIOUS = ep_config['secrets'].get('master-salt-previous') or []
+if isinstance(MASTER_SALT_PREVIOUS, (str, dict)):
+    MASTER_SALT_PREVIOUS = [MASTER_SALT_PREVIOUS]
+
+# Encryption
+ENCRYPTION_CONFIG = ep_config.get('encryption') or {}
+PERSONALKEY_CACHE_SIZE = ENCRYPTION_CONFIG.get('personalkey-cache-size', 1024)  # one entry per active user
+PERSONALKEY_CACHE_TTL = ENCRYPTION_CONFIG.get('personalkey-cache-ttl', 3600)  # seconds, 0 disables expiry
+# algorithm$params of the KDFs, e.g. scrypt$n=16384,r=8,p=1; pick them with calibrate_kdf
+KDF = ENCRYPTION_CONFIG.get('kdf', 'pbkdf2-sha256$iterations=100000')  # personal keys, upgraded on read
+MASTER_KDF = ENCRYPTION_CONFIG.get('master-kdf', 'pbkdf2-sha256$iterations=100000')  # change with rotate_masterkey
+DECRYPT_WORKERS = ENCRYPTION_CONFIG.get('decrypt-workers', 4)  # 1 keeps list decryption serial
+DECRYPT_BATCH_MIN = ENCRYPTION_CONFIG.get('decrypt-batch-min', 64)  # smaller lists are decrypted serially
 
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = ep_config['application']['debug']
 DEBUG_LEVEL = ep_config['application']['debug-level'].upper()
+# list endpoints page with ?cursor=, ?page_size= can go up to MAX_PAGE_SIZE
+PAGE_SIZE = ep_config['application'].get('page-size', 100)
+MAX_PAGE_SIZE = ep_config['application'].get('max-page-size', 1000)
+STREAM_CHUNK_SIZE = ep_config['application'].get('stream-chunk-size', 500)  # rows per cursor fetch with ?stream=true
+# max-age of the access level, owner and password type lists
+REFERENCE_CACHE_MAX_AGE = ep_config['application'].get('reference-cache-max-age', 86400)
 
 ALLOWED_HOSTS = ['*']
 
@@ -231,8 +252,16 @@ REST_FRAMEWORK = {
         'rest_framework_jwt.authentication.JSONWebTokenAuthentication',
     ),
     'DEFAULT_RENDERER_CLASSES': (
+        'core.renderers.FastJSONRenderer',
+        'core.renderers.MessagePackRenderer',
         'rest_framework.renderers.JSONRenderer',
     ),
+    'DEFAULT_PARSER_CLASSES': (
+        'rest_framework.parsers.JSONParser',
+        'core.renderers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
     'TEST_REQUEST_DEFAULT_FORMAT': 'json'
 }
 
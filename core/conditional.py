@@ -0,0 +1,48 @@
+import hashlib
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.response import Response
+
+from passwordfolders.models import PasswordFolderACL
+
+
+def list_etag(request, queryset):
+    """
+    Weak ETag of a list response, from the newest `modified` and row count of the visible `queryset`, the same
+    for the user's folder ACLs, and the parameters that shape the response.
+    """
+    rows = queryset.order_by().aggregate(modified=Max('modified'), count=Count('id'))
+    acls = PasswordFolderACL.objects.filter(user=request.user).aggregate(modified=Max('modified'), count=Count('id'))
+    state = '|'.join(str(part) for part in (request.user.pk, rows['modified'], rows['count'], acls['modified'],
+                                            acls['count'], request.get_full_path(), request.META.get('HTTP_ACCEPT')))
+    return 'W/"{}"'.format(hashlib.sha256(state.encode('utf-8')).hexdigest()[:32])
+
+def not_modified(request, etag):
+    """
+    Return a 304 response when If-None-Match of `request` matches `etag`, else None.
+    """
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return None
+    # weak comparison, as for any GET
+    etags = [tag[2:] if tag.startswith('W/') else tag for tag in parse_etags(header)]
+    if '*' in etags or etag[2:] in etags:
+        return set_validators(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+    return None
+
+def set_validators(response, etag):
+    # the content depends on who asks and how it is rendered, shared caches must revalidate it per user
+    response['ETag'] = etag
+    patch_vary_headers(response, ('Accept', 'Authorization', 'Cookie'))
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+def set_reference_cache(response):
+    # reference tables change with a deployment, not per request: clients keep them for REFERENCE_CACHE_MAX_AGE
+    patch_vary_headers(response, ('Accept', 'Authorization', 'Cookie'))
+    patch_cache_control(response, private=True, max_age=getattr(settings, 'REFERENCE_CACHE_MAX_AGE', 86400))
+    return response
@@ -0,0 +1,93 @@
+import time
+
+from cryptography.fernet import InvalidToken
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.scripts.bulk import bulk_update
+from core.scripts.encryption import (combine_keys,
+                                     decrypt_aead,
+                                     decrypt_secret,
+                                     generate_key_id,
+                                     get_fernet,
+                                     LEGACY_KDF,
+                                     masterkey_provider,
+                                     personalkey_cache)
+from passwords.models import Password
+
+
+class Command(BaseCommand):
+    help = 'Fill in Password.scheme and Password.key_id for rows written before those columns existed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help='Rows classified per transaction')
+
+    def handle(self, *args, **options):
+        self.datakeys = {}
+        self.folder_users = {}
+        last_pk = 0
+        total = 0
+        started = time.perf_counter()
+        queryset = Password.objects.filter(scheme__isnull=True).select_related('folder__user')
+        while True:
+            with transaction.atomic():
+                rows = list(queryset.select_for_update(of=('self',)).filter(pk__gt=last_pk)
+                            .order_by('pk')[:options['chunk_size']])
+                if not rows:
+                    break
+                for row in rows:
+                    row.scheme, row.key_id = self.classify(row)
+                bulk_update(Password, rows, ['scheme', 'key_id'])
+                last_pk = rows[-1].pk
+            total += len(rows)
+            elapsed = time.perf_counter() - started
+            self.stdout.write('{} rows classified up to pk {} ({:.1f} rows/sec)'.format(
+                total, last_pk, total / elapsed if elapsed else 0))
+
+    def classify(self, password):
+        scheme = password.get_scheme()
+        if scheme == Password.SCHEME_PLAINTEXT:
+            return Password.SCHEME_PLAINTEXT, ''
+        datakey = self.get_datakey(password.folder)
+        if scheme == Password.SCHEME_AEAD:
+            return Password.SCHEME_AEAD, self.get_aead_key_id(datakey, password) if datakey else ''
+        if datakey is not None:
+            try:
+                decrypt_secret(datakey, password.password)
+                return Password.SCHEME_FOLDERKEY, generate_key_id(datakey)
+            except InvalidToken:
+                pass
+        return Password.SCHEME_LEGACY, self.get_masterkey_id(password)
+
+    def get_datakey(self, folder):
+        if folder.pk not in self.datakeys:
+            self.datakeys[folder.pk] = folder.unwrap_any_datakey()
+        return self.datakeys[folder.pk]
+
+    def get_aead_key_id(self, datakey, password):
+        for masterkey in masterkey_provider.keys:
+            aead_key = combine_keys(masterkey, datakey)
+            try:
+                decrypt_aead(aead_key, password.secret)
+            except InvalidToken:
+                continue
+            return generate_key_id(aead_key)
+        return ''
+
+    def get_masterkey_id(self, password):
+        # the creator is not recorded: try every user that may have encrypted the row
+        if password.folder.pk not in self.folder_users:
+            self.folder_users[password.folder.pk] = password.folder.get_key_holders()
+        for user in self.folder_users[password.folder.pk]:
+            personalkey = get_fernet(personalkey_cache.get(user.uuid, user.password, LEGACY_KDF))
+            try:
+                inner = personalkey.decrypt(password.password.encode('utf-8'))
+            except InvalidToken:
+                continue
+            for key in masterkey_provider.keys:
+                try:
+                    get_fernet(key).decrypt(inner)
+                except InvalidToken:
+                    continue
+                return generate_key_id(key)
+        return ''
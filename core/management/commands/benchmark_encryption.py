@@ -0,0 +1,209 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.http import HttpRequest, QueryDict
+from django.test import override_settings
+from rest_framework.request import Request
+
+from core.models import AccessLevel, Owner, User
+from core.registry import access_levels
+from core.scripts import encryption
+from core.scripts.encryption import (combine_keys,
+                                     decrypt_aead,
+                                     decrypt_password,
+                                     decrypt_secret,
+                                     decrypt_secrets,
+                                     encrypt_aead,
+                                     encrypt_password,
+                                     encrypt_secret,
+                                     generate_datakey,
+                                     generate_masterkey,
+                                     generate_personalkey,
+                                     get_aead,
+                                     get_fernet,
+                                     MasterKeyProvider,
+                                     PersonalKeyCache,
+                                     unwrap_datakey,
+                                     wrap_datakey)
+from passwordfolders.models import PasswordFolder, PasswordFolderACL
+from passwords.models import Password
+from passwords.serializers import PasswordSerializer
+
+
+class Rollback(Exception):
+    pass
+
+
+def percentile(samples, percent):
+    ordered = sorted(samples)
+    index = max(int(round(percent / 100.0 * len(ordered))) - 1, 0)
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the primitives in core.scripts.encryption and password list decryption at several batch '
+            'sizes and thread counts. The list measurements time decryption alone, with the keys built up front; '
+            '--round-trip adds encrypt and serialize round trips through PasswordSerializer and its KeyContext. '
+            'Prints JSON (ops/sec, p50/p99 in milliseconds) for comparing releases.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-sizes', default='1,10,100,1000', help='Comma separated passwords per list')
+        parser.add_argument('--threads', default='1,2,4,8', help='Comma separated decryption pool sizes')
+        parser.add_argument('--repeat', type=int, default=5, help='Samples taken per measurement')
+        parser.add_argument('--legacy', action='store_true',
+                            help='Also time lists that derive the master and personal keys for every row')
+        parser.add_argument('--round-trip', action='store_true',
+                            help='Also time PasswordSerializer encrypt and list round trips; seeds a user and folder '
+                                 'in the database inside a transaction that is rolled back')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        batch_sizes = [int(size) for size in options['batch_sizes'].split(',')]
+        thread_counts = [int(count) for count in options['threads'].split(',')]
+
+        user_uuid = uuid4()
+        user_password = 'pbkdf2_sha256$100000$benchmark$hash'
+        provider = MasterKeyProvider('28beatty')
+        masterkey = provider.fernet
+        personalkey = generate_personalkey(user_uuid, user_password)
+        cache = PersonalKeyCache()
+        datakey = generate_datakey()
+        wrapped_key = wrap_datakey(masterkey, personalkey, datakey)
+        legacy_secret = encrypt_password(masterkey, personalkey, 'benchmark-secret')
+        secret = encrypt_secret(datakey, 'benchmark-secret')
+        aead_key = get_aead(combine_keys(provider.key, datakey))
+        aead_secret = encrypt_aead(aead_key, 'benchmark-secret')
+
+        results = [
+            self.measure('generate_masterkey', lambda: generate_masterkey('28beatty')),
+            self.measure('generate_personalkey', lambda: generate_personalkey(user_uuid, user_password)),
+            self.measure('personalkey_cache.get', lambda: cache.get(user_uuid, user_password)),
+            self.measure('encrypt_password', lambda: encrypt_password(masterkey, personalkey, 'benchmark-secret')),
+            self.measure('decrypt_password', lambda: decrypt_password(masterkey, personalkey, legacy_secret)),
+            self.measure('wrap_datakey', lambda: wrap_datakey(masterkey, personalkey, datakey)),
+            self.measure('unwrap_datakey', lambda: unwrap_datakey(masterkey, personalkey, wrapped_key)),
+            self.measure('encrypt_secret', lambda: encrypt_secret(datakey, 'benchmark-secret')),
+            self.measure('decrypt_secret', lambda: decrypt_secret(datakey, secret)),
+            self.measure('combine_keys', lambda: combine_keys(provider.key, datakey)),
+            self.measure('encrypt_aead', lambda: encrypt_aead(aead_key, 'benchmark-secret')),
+            self.measure('decrypt_aead', lambda: decrypt_aead(aead_key, aead_secret)),
+        ]
+
+        for batch_size in batch_sizes:
+            if options['legacy']:
+                results.append(self.measure('list_legacy_per_row_kdf', self.legacy_list(
+                    user_uuid, user_password, [legacy_secret] * batch_size), ops=batch_size, batch_size=batch_size))
+            for threads in thread_counts:
+                pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+
+                # one serialized list: personal key from the cache, one unwrap per folder, then the batch
+                def folderkey_list(secrets=[secret] * batch_size, pool=pool):
+                    folder_key = get_fernet(unwrap_datakey(masterkey, cache.get(user_uuid, user_password),
+                                                           wrapped_key))
+                    jobs = [(decrypt_secret, folder_key, s) for s in secrets]
+                    if pool is None:
+                        return [decrypt_secret(key, s) for decrypt, key, s in jobs]
+                    return decrypt_secrets(jobs, pool=pool)
+
+                # the same list stored as single pass AEAD ciphertexts
+                def aead_list(secrets=[aead_secret] * batch_size, pool=pool):
+                    datakey = unwrap_datakey(masterkey, cache.get(user_uuid, user_password), wrapped_key)
+                    folder_key = get_aead(combine_keys(provider.key, datakey))
+                    jobs = [(decrypt_aead, folder_key, s) for s in secrets]
+                    if pool is None:
+                        return [decrypt_aead(key, s) for decrypt, key, s in jobs]
+                    return decrypt_secrets(jobs, pool=pool)
+
+                results.append(self.measure('list_folderkey', folderkey_list, ops=batch_size,
+                                            batch_size=batch_size, threads=threads))
+                results.append(self.measure('list_aead', aead_list, ops=batch_size,
+                                            batch_size=batch_size, threads=threads))
+                if pool is not None:
+                    pool.shutdown()
+
+        if options['round_trip']:
+            results.extend(self.round_trips(batch_sizes, thread_counts))
+
+        report = json.dumps({'repeat': self.repeat, 'results': results}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report)
+        else:
+            self.stdout.write(report)
+
+    def round_trips(self, batch_sizes, thread_counts):
+        if not AccessLevel.objects.exists() or not Owner.objects.exists():
+            raise CommandError('Load the accesslevel and owner fixtures first.')
+        results = []
+        try:
+            with transaction.atomic():
+                user = User.objects.create_user(username='benchmark-{}'.format(uuid4().hex), password='benchmark',
+                                                email='benchmark@example.com')
+                folder = PasswordFolder.objects.create(name='Benchmark', description='Benchmark Folder')
+                PasswordFolderACL.objects.create(user=user, folder=folder, level=access_levels.get(name='Owner'))
+                for batch_size in batch_sizes:
+                    passwords = [Password(pk=i + 1, name='Benchmark', folder=folder) for i in range(batch_size)]
+                    for threads in thread_counts:
+                        pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+                        round_trip = self.serializer_round_trip(user, folder, passwords, threads, pool)
+                        if any(item['password'] != 'benchmark-secret' for item in round_trip()):
+                            raise CommandError('The serializer round trip did not return the secret.')
+                        results.append(self.measure('round_trip_serializer', round_trip, ops=batch_size,
+                                                    batch_size=batch_size, threads=threads))
+                        if pool is not None:
+                            pool.shutdown()
+                raise Rollback
+        except Rollback:
+            pass
+        return results
+
+    def serializer_round_trip(self, user, folder, passwords, threads, pool):
+        # one request: encrypt every secret as create and update do, then serialize the list, which unwraps the
+        # folder key through KeyContext and decrypts the batch on the decryption pool, sized to `threads`
+        def run():
+            request = Request(HttpRequest())
+            request._request.method = 'GET'
+            request._request.GET = QueryDict('exclude=tags')
+            request.user = user
+            previous_pool, encryption._decrypt_pool = encryption._decrypt_pool, pool
+            try:
+                with override_settings(DECRYPT_WORKERS=threads, DECRYPT_BATCH_MIN=1):
+                    serializer = PasswordSerializer(context={'request': request})
+                    for password in passwords:
+                        for field, value in serializer.encrypt(folder, 'benchmark-secret').items():
+                            setattr(password, field, value)
+                        password.decrypted = False
+                    return PasswordSerializer(passwords, many=True, context={'request': request}).data
+            finally:
+                encryption._decrypt_pool = previous_pool
+        return run
+
+    def legacy_list(self, user_uuid, user_password, secrets):
+        def run():
+            for s in secrets:
+                decrypt_password(generate_masterkey('28beatty'), generate_personalkey(user_uuid, user_password), s)
+        return run
+
+    def measure(self, name, run, ops=1, batch_size=None, threads=None):
+        run()  # warm up caches and pools outside the samples
+        samples = []
+        for i in range(self.repeat):
+            start = time.perf_counter()
+            run()
+            samples.append(time.perf_counter() - start)
+        result = {
+            'name': name,
+            'ops_per_sec': round(ops * len(samples) / sum(samples), 2),
+            'p50_ms': round(percentile(samples, 50) * 1000, 3),
+            'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        }
+        if batch_size is not None:
+            result['batch_size'] = batch_size
+        if threads is not None:
+            result['threads'] = threads
+        return result
@@ -0,0 +1,170 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from core.management.commands.benchmark_encryption import percentile
+from core.models import AccessLevel, Owner, User
+from passwordfolders.models import PasswordFolder, PasswordFolderAccess, PasswordFolderACL, refresh_access
+from passwords.models import Password, PasswordACL
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ('Seed a synthetic vault inside a transaction and time the permission and list hot paths on it. '
+            'Prints JSON (queries/sec, p50/p99 in milliseconds, query plan) per query; run it before and after '
+            'migrating to compare. The seeded rows are rolled back unless --keep is given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000, help='Passwords seeded')
+        parser.add_argument('--users', type=int, default=1000, help='Users seeded')
+        parser.add_argument('--folders', type=int, default=10000, help='Shared folders seeded')
+        parser.add_argument('--acls-per-folder', type=int, default=5, help='Folder ACLs seeded per shared folder')
+        parser.add_argument('--repeat', type=int, default=100, help='Samples taken per query')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Rows per bulk insert')
+        parser.add_argument('--keep', action='store_true', help='Commit the seeded rows instead of rolling back')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        self.repeat = options['repeat']
+        self.batch_size = options['batch_size']
+        self.random = random.Random(0)
+        if not AccessLevel.objects.exists() or not Owner.objects.exists():
+            raise CommandError('Load the accesslevel and owner fixtures first.')
+        try:
+            with transaction.atomic():
+                report = self.run(options)
+                if not options['keep']:
+                    raise Rollback
+        except Rollback:
+            pass
+        report = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report)
+        else:
+            self.stdout.write(report)
+
+    def run(self, options):
+        started = time.perf_counter()
+        users, folders = self.seed(options)
+        seed_seconds = time.perf_counter() - started
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+
+        def pick_user():
+            return self.random.choice(users)
+
+        def pick_folder():
+            return self.random.choice(folders)
+
+        acl_pairs = list(PasswordFolderACL.objects.filter(folder__personal=False).values_list('folder_id', 'user_id')
+                         .order_by('?')[:self.repeat])
+        def folder_acl():
+            folder, user = self.random.choice(acl_pairs)
+            return PasswordFolderACL.objects.filter(folder_id=folder, user_id=user)
+
+        def folder_access():
+            # the query of has_access(), as every permission check runs it
+            folder, user = self.random.choice(acl_pairs)
+            return PasswordFolderAccess.objects.filter(user_id=user, folder_id=folder,
+                                                       level__rank__gte=AccessLevel.MODIFY).values('pk')[:1]
+
+        queries = [
+            ('folder_acl_by_folder_user', folder_acl),
+            ('has_access', folder_access),
+            ('password_acl_by_user', lambda: PasswordACL.objects.filter(user_id=pick_user())[:100]),
+            ('passwords_by_folder_name', lambda: Password.objects.filter(folder_id=pick_folder()).order_by('name')[:100]),
+            ('personal_folder', lambda: PasswordFolder.objects.filter(user_id=pick_user(), personal=True)),
+            ('visible_passwords_page', lambda: Password.objects.visible_to(pick_user()).order_by('-modified', '-id')[:100]),
+        ]
+        return {'rows': options['rows'],
+                'users': len(users),
+                'folders': len(folders),
+                'access_rows': PasswordFolderAccess.objects.filter(folder_id__in=folders).count(),
+                'seed_seconds': round(seed_seconds, 2),
+                'vendor': connection.vendor,
+                'results': [self.measure(name, build) for name, build in queries]}
+
+    def seed(self, options):
+        tag = str(int(time.time()))
+        self.bulk_create(User, (User(username='bench-{}-{}'.format(tag, i), email='bench-{}-{}@example.com'.format(tag, i),
+                                     password='pbkdf2_sha256$100000$bench$hash') for i in range(options['users'])))
+        users = list(User.objects.filter(username__startswith='bench-{}-'.format(tag)).values_list('pk', flat=True))
+        owner = Owner.objects.first()
+        # personal folders plus the shared ones, each a root of its own mptt tree
+        tree_id = (PasswordFolder.objects.order_by('-tree_id').values_list('tree_id', flat=True).first() or 0) + 1
+        folders = [PasswordFolder(name='Personal', description='Personal Folder', owner=owner, personal=True,
+                                  user_id=user, lft=1, rght=2, level=0, tree_id=tree_id + i)
+                   for i, user in enumerate(users)]
+        tree_id += len(folders)
+        folders += [PasswordFolder(name='Bench {}'.format(i), description='Shared Folder', owner=owner,
+                                   lft=1, rght=2, level=0, tree_id=tree_id + i) for i in range(options['folders'])]
+        self.bulk_create(PasswordFolder, folders)
+        seeded = PasswordFolder.objects.filter(tree_id__gte=tree_id - len(users))
+        personal = dict(seeded.filter(personal=True).values_list('user_id', 'pk'))
+        shared = list(seeded.filter(personal=False).values_list('pk', flat=True))
+
+        levels = list(AccessLevel.objects.values_list('pk', flat=True))
+        owner_level = AccessLevel.objects.filter(name='Owner').values_list('pk', flat=True).first() or levels[0]
+
+        def folder_acls():
+            for user, folder in personal.items():
+                yield PasswordFolderACL(user_id=user, folder_id=folder, level_id=owner_level)
+            for folder in shared:
+                for user in self.random.sample(users, min(options['acls_per_folder'], len(users))):
+                    yield PasswordFolderACL(user_id=user, folder_id=folder, level_id=self.random.choice(levels))
+        self.bulk_create(PasswordFolderACL, folder_acls())
+        # bulk_create skips the ACL signals that fill the effective access table
+        for folder in seeded:
+            refresh_access(folder)
+
+        all_folders = shared + list(personal.values())
+        self.bulk_create(Password, (Password(name='Password {}'.format(i), description='Seeded Password',
+                                             username='user{}'.format(i), password='plain', url='https://example.com',
+                                             folder_id=self.random.choice(all_folders), scheme=Password.SCHEME_PLAINTEXT)
+                                    for i in range(options['rows'])))
+        passwords = Password.objects.filter(description='Seeded Password').values_list('pk', flat=True)
+        granted = set()
+
+        def password_acls():
+            for password in passwords.iterator():
+                if self.random.random() < 0.1:
+                    user = self.random.choice(users)
+                    if (user, password) not in granted:
+                        granted.add((user, password))
+                        yield PasswordACL(user_id=user, password_id=password)
+        self.bulk_create(PasswordACL, password_acls())
+        return users, all_folders
+
+    def bulk_create(self, model, objs):
+        batch = []
+        for obj in objs:
+            batch.append(obj)
+            if len(batch) == self.batch_size:
+                model.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            model.objects.bulk_create(batch)
+
+    def measure(self, name, build):
+        plan = build().explain()
+        samples = []
+        for i in range(self.repeat):
+            queryset = build()
+            start = time.perf_counter()
+            list(queryset)
+            samples.append(time.perf_counter() - start)
+        return {
+            'name': name,
+            'queries_per_sec': round(len(samples) / sum(samples), 2),
+            'p50_ms': round(percentile(samples, 50) * 1000, 3),
+            'p99_ms': round(percentile(samples, 99) * 1000, 3),
+            'plan': plan,
+        }
@@ -0,0 +1,72 @@
+import json
+import time
+from collections import OrderedDict
+from uuid import uuid4
+
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+from taggit_serializer.serializers import TagList
+
+from core.management.commands.benchmark_encryption import percentile
+from core.renderers import FastJSONRenderer, MessagePackRenderer
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the API renderers on password lists shaped like PasswordSerializer output. Prints JSON '
+            '(lists/sec, p50/p99 in milliseconds, payload bytes) per renderer and list size.')
+
+    renderers = OrderedDict([('json', JSONRenderer),
+                             ('fastjson', FastJSONRenderer),
+                             ('msgpack', MessagePackRenderer)])
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10,100,1000,10000', help='Comma separated passwords per list')
+        parser.add_argument('--renderers', default=','.join(self.renderers),
+                            help='Comma separated renderers out of {}'.format(', '.join(self.renderers)))
+        parser.add_argument('--repeat', type=int, default=5, help='Samples taken per measurement')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        results = []
+        for size in sizes:
+            data = self.password_list(size)
+            for name in options['renderers'].split(','):
+                renderer = self.renderers[name]()
+                results.append(self.measure(name, renderer, data, options['repeat']))
+        report = json.dumps({'repeat': options['repeat'], 'results': results}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report)
+        else:
+            self.stdout.write(report)
+
+    def password_list(self, size):
+        return [OrderedDict([('id', i),
+                             ('type', 1),
+                             ('name', 'Password {}'.format(i)),
+                             ('description', 'Service account for the staging database cluster'),
+                             ('url', 'https://db{}.staging.example.com/admin/'.format(i)),
+                             ('username', 'svc-{}'.format(uuid4().hex[:12])),
+                             ('password', uuid4().hex + uuid4().hex[:8]),
+                             ('folder', i % 50 + 1),
+                             ('tags', TagList(['staging', 'database'])),
+                             ('created', '2018-11-20T14:03:27.512034Z'),
+                             ('modified', '2018-12-01T09:41:02.007215Z')])
+                for i in range(size)]
+
+    def measure(self, name, renderer, data, repeat):
+        payload = renderer.render(data)  # warm up outside the samples
+        samples = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            renderer.render(data)
+            samples.append(time.perf_counter() - start)
+        return {
+            'name': name,
+            'size': len(data),
+            'lists_per_sec': round(len(samples) / sum(samples), 2),
+            'p50_ms': round(percentile(samples, 50) * 1000, 3),
+            'p99_ms': round(percentile(samples, 99) * 1000, 3),
+            'bytes': len(payload),
+        }
@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.scripts.encryption import KDFS, kdf_descriptor
+
+
+class Command(BaseCommand):
+    help = ('Pick KDF parameters that take about --target-ms to derive a key on this host. '
+            'Put the printed descriptor in encryption.kdf of settings.yaml.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--algorithm', default='pbkdf2-sha256', choices=sorted(KDFS))
+        parser.add_argument('--target-ms', type=float, default=100.0, help='Target derive time in milliseconds')
+        parser.add_argument('--samples', type=int, default=3, help='Derivations timed per candidate')
+
+    def handle(self, *args, **options):
+        target = options['target_ms'] / 1000.0
+        if target <= 0:
+            raise CommandError('--target-ms must be positive.')
+        self.samples = options['samples']
+        kdf = KDFS[options['algorithm']]
+        if options['algorithm'] == 'pbkdf2-sha256':
+            # derive time grows linearly with the iteration count
+            probe = kdf(iterations=10000)
+            iterations = max(int(probe.iterations * target / self.time(probe)), 10000)
+            kdf = kdf(iterations=iterations)
+        else:
+            # double the scrypt cost until the target is reached
+            n = 2 ** 10
+            while self.time(kdf(n=n)) < target and n < 2 ** 20:
+                n *= 2
+            kdf = kdf(n=n)
+        self.stdout.write('{} ({:.1f}ms per derive)'.format(kdf_descriptor(kdf), self.time(kdf) * 1000))
+
+    def time(self, kdf):
+        samples = []
+        for i in range(self.samples):
+            start = time.perf_counter()
+            kdf.derive(b'calibration-password', b'calibration-salt')
+            samples.append(time.perf_counter() - start)
+        return min(samples)
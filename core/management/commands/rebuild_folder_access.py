@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from passwordfolders.models import PasswordFolder, PasswordFolderAccess, refresh_access
+
+
+class Command(BaseCommand):
+    help = ('Regenerate the effective folder access table from the folder ACLs and the folder tree. Run it after '
+            'migrating, and after bulk changes that bypass signals.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        with transaction.atomic():
+            PasswordFolderAccess.objects.all().delete()
+            roots = PasswordFolder.objects.filter(parent__isnull=True)
+            for root in roots:
+                refresh_access(root)
+        self.stdout.write('{} access rows for {} folder trees ({:.1f} sec)'.format(
+            PasswordFolderAccess.objects.count(), roots.count(), time.perf_counter() - started))
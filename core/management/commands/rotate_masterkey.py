@@ -0,0 +1,193 @@
+import time
+from collections import Counter
+
+from cryptography.fernet import InvalidToken
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from core.models import SystemSetting
+from core.scripts.bulk import bulk_update
+from core.scripts.encryption import (combine_keys,
+                                     decrypt_aead,
+                                     decrypt_password,
+                                     encrypt_aead,
+                                     generate_key_id,
+                                     LEGACY_KDF,
+                                     master_salt_entry,
+                                     MasterKeyProvider,
+                                     personalkey_cache,
+                                     rotate_password)
+from passwordfolders.models import PasswordFolderACL
+from passwords.models import Password
+
+
+class Command(BaseCommand):
+    help = ('Re-encrypt wrapped folder keys, AEAD and legacy passwords from a previous master salt to MASTER_SALT. '
+            'Deploy the new salt with the old one in master-salt-previous, run this command, then drop the '
+            'old salt once it reports no rows left on the old key. Progress is checkpointed per chunk, so an '
+            'interrupted run resumes where it stopped.')
+
+    checkpoint_names = {'acl': 'masterkey-rotation-acl',
+                        'aead': 'masterkey-rotation-aead',
+                        'password': 'masterkey-rotation-password'}
+
+    def add_arguments(self, parser):
+        parser.add_argument('--old-salt', help='Salt being rotated out (default: first master-salt-previous)')
+        parser.add_argument('--old-kdf', help='Master KDF being rotated out (default: the kdf of the first '
+                                              'master-salt-previous, else MASTER_KDF)')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Rows re-encrypted per transaction')
+        parser.add_argument('--restart', action='store_true', help='Ignore saved checkpoints and start over')
+
+    def handle(self, *args, **options):
+        old_salt, previous_kdf = options['old_salt'], None
+        if old_salt is None:
+            previous = getattr(settings, 'MASTER_SALT_PREVIOUS', [])
+            if previous:
+                old_salt, previous_kdf = master_salt_entry(previous[0])
+            elif options['old_kdf']:
+                old_salt = settings.MASTER_SALT
+            else:
+                raise CommandError('No --old-salt given and master-salt-previous is not configured.')
+        old_kdf = options['old_kdf'] or previous_kdf or getattr(settings, 'MASTER_KDF', LEGACY_KDF)
+        if (old_salt, old_kdf) == (settings.MASTER_SALT, getattr(settings, 'MASTER_KDF', LEGACY_KDF)):
+            raise CommandError('The old salt and KDF are the current ones.')
+        if options['restart']:
+            SystemSetting.objects.filter(name__in=self.checkpoint_names.values()).delete()
+
+        old_provider = MasterKeyProvider('28beatty', salts=[old_salt], kdf=old_kdf)
+        self.old_masterkey = old_provider.fernet
+        self.old_raw_masterkey = old_provider.key
+        new_provider = MasterKeyProvider('28beatty', salts=[settings.MASTER_SALT])
+        self.new_masterkey = new_provider.fernet
+        self.new_raw_masterkey = new_provider.key
+        self.new_masterkey_id = new_provider.key_id
+        self.chunk_size = options['chunk_size']
+        self.folder_users = {}
+        self.aead_keys = {}
+        self.skipped = Counter()
+
+        self.rotate('acl', PasswordFolderACL.objects.filter(wrapped_key__isnull=False).select_related('user'),
+                    self.rotate_acl, ['wrapped_key'])
+        self.rotate('aead', Password.objects.filter(scheme=Password.SCHEME_AEAD).select_related('folder'),
+                    self.rotate_aead_password, ['secret', 'key_id'])
+        legacy = Password.objects.exclude(scheme__in=[Password.SCHEME_PLAINTEXT, Password.SCHEME_FOLDERKEY,
+                                                      Password.SCHEME_AEAD])
+        self.rotate('password', legacy.select_related('folder__user'),
+                    self.rotate_legacy_password, ['password', 'key_id'])
+        SystemSetting.objects.filter(name__in=self.checkpoint_names.values()).delete()
+        if sum(self.skipped.values()):
+            # rows no holder key could open: dropping the old salt would leave them unreadable for good
+            raise CommandError('Rows left on the old master key: {}. Keep master-salt-previous, fix their keys and '
+                               'run again.'.format(', '.join('{} {}'.format(count, table) for table, count
+                                                             in sorted(self.skipped.items()))))
+        self.stdout.write('Rotation complete. master-salt-previous can now be removed.')
+
+    def get_checkpoint(self, table):
+        checkpoint, created = SystemSetting.objects.get_or_create(
+            name=self.checkpoint_names[table],
+            defaults={'description': 'Last primary key re-encrypted by rotate_masterkey', 'value': '0'})
+        return checkpoint
+
+    def rotate(self, table, queryset, rotate_row, fields):
+        # the checkpoint holds the last primary key done and, after a comma, the rows skipped so far
+        checkpoint = self.get_checkpoint(table)
+        last_pk, _, skipped = checkpoint.value.partition(',')
+        last_pk = int(last_pk)
+        self.table = table
+        self.skipped[table] = int(skipped or 0)
+        total = 0
+        started = time.perf_counter()
+        while True:
+            # short transaction per chunk: only the rows of the chunk are locked while they are rewritten
+            with transaction.atomic():
+                rows = list(queryset.select_for_update(of=('self',)).filter(pk__gt=last_pk).order_by('pk')[:self.chunk_size])
+                if not rows:
+                    break
+                changed = [row for row in rows if rotate_row(row)]
+                bulk_update(queryset.model, changed, fields)
+                last_pk = rows[-1].pk
+                checkpoint.value = '{},{}'.format(last_pk, self.skipped[table])
+                checkpoint.save(update_fields=['value'])
+            total += len(changed)
+            elapsed = time.perf_counter() - started
+            self.stdout.write('{}: {} rows re-encrypted, {} skipped up to pk {} ({:.1f} rows/sec)'.format(
+                table, total, self.skipped[table], last_pk, total / elapsed if elapsed else 0))
+
+    def skip(self, row):
+        self.stderr.write('{}: pk {} cannot be re-encrypted and stays on the old master key'.format(self.table,
+                                                                                                   row.pk))
+        self.skipped[self.table] += 1
+        return False
+
+    def is_current(self, personalkey, token):
+        # wrapped or encrypted with the new master key already, e.g. by a live request since the deploy
+        try:
+            decrypt_password(self.new_masterkey, personalkey, token)
+        except InvalidToken:
+            return False
+        return True
+
+    def rotate_acl(self, acl):
+        personalkey = personalkey_cache.get(acl.user.uuid, acl.user.password, acl.kdf or LEGACY_KDF)
+        try:
+            acl.wrapped_key = rotate_password(self.old_masterkey, self.new_masterkey, personalkey, acl.wrapped_key)
+        except InvalidToken:
+            return False if self.is_current(personalkey, acl.wrapped_key) else self.skip(acl)
+        return True
+
+    def rotate_aead_password(self, password):
+        keys = self.get_aead_keys(password.folder)
+        if keys is None:
+            # no ACL holder of the folder's data key
+            return self.skip(password)
+        if password.key_id == keys[2]:
+            return False
+        try:
+            secret = decrypt_aead(keys[0], password.secret)
+        except InvalidToken:
+            try:
+                decrypt_aead(keys[1], password.secret)
+            except InvalidToken:
+                return self.skip(password)
+            return False
+        password.secret = encrypt_aead(keys[1], secret)
+        password.key_id = keys[2]
+        return True
+
+    def get_aead_keys(self, folder):
+        # (old key, new key, new key id) of the folder, read through any holder of its data key
+        if folder.pk not in self.aead_keys:
+            datakey = folder.unwrap_any_datakey()
+            if datakey is None:
+                self.aead_keys[folder.pk] = None
+            else:
+                new_key = combine_keys(self.new_raw_masterkey, datakey)
+                self.aead_keys[folder.pk] = (combine_keys(self.old_raw_masterkey, datakey), new_key,
+                                             generate_key_id(new_key))
+        return self.aead_keys[folder.pk]
+
+    def rotate_legacy_password(self, password):
+        # only double encrypted passwords depend on the master key; the creator is not recorded,
+        # so the folder's owner and ACL holders are tried in turn
+        if password.get_scheme() == Password.SCHEME_PLAINTEXT or password.key_id == self.new_masterkey_id:
+            return False
+        users = self.get_folder_users(password.folder)
+        for user in users:
+            try:
+                password.password = rotate_password(self.old_masterkey, self.new_masterkey,
+                                                    personalkey_cache.get(user.uuid, user.password, LEGACY_KDF),
+                                                    password.password)
+            except InvalidToken:
+                continue
+            password.key_id = self.new_masterkey_id
+            return True
+        for user in users:
+            if self.is_current(personalkey_cache.get(user.uuid, user.password, LEGACY_KDF), password.password):
+                return False
+        return self.skip(password)
+
+    def get_folder_users(self, folder):
+        if folder.pk not in self.folder_users:
+            self.folder_users[folder.pk] = folder.get_key_holders()
+        return self.folder_users[folder.pk]
@@ -1,5 +1,5 @@
 from django.db import models
-from django.db.models.signals import pre_delete, post_delete, pre_save, post_save
+from django.db.models.signals import pre_delete, post_delete, post_migrate, pre_save, post_save
 from django.conf import settings
 from django.dispatch import receiver
 from django.contrib.auth.models import PermissionsMixin
@@ -7,14 +7,16 @@ from django.contrib.auth.base_user import AbstractBaseUser
 from uuid import uuid4
 
 from .managers import UserManager
-from passwordfolders.models import PasswordFolder, PasswordFolderACL
+from .registry import access_levels, owners
+from .scripts.encryption import personalkey_cache
+from passwordfolders.models import ACCESS_RANKS, PasswordFolder, PasswordFolderACL
 
 
 # Create a Personal Folder for the User when added to the System
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_personal_list(sender, instance=None, created=False, **kwargs):
     if created:
-        owner = Owner.objects.get(name='Personal')
+        owner = owners.get(name='Personal')
         PasswordFolder.objects.create(name='Personal',
                                       description='Personal Folder'.format(instance),
                                       owner=owner,
@@ -23,7 +25,37 @@ def create_personal_list(sender, instance=None, created=False, **kwargs):
                                       parent=None)
         PasswordFolderACL.objects.create(user=instance,
                                          folder=PasswordFolder.objects.get(user=instance),
-                                         level=AccessLevel.objects.get(name='Owner'))
+                                         level=access_levels.get(name='Owner'))
+
+
+# Re-wrap the User's folder data keys when their password hash changes
+@receiver(pre_save, sender=settings.AUTH_USER_MODEL)
+def rewrap_folder_keys(sender, instance=None, raw=False, update_fields=None, **kwargs):
+    if raw or instance.pk is None or (update_fields is not None and 'password' not in update_fields):
+        return
+    previous = sender.objects.filter(pk=instance.pk).values_list('password', flat=True).first()
+    if previous is None or previous == instance.password:
+        return
+    for acl in PasswordFolderACL.objects.select_related('user').filter(user=instance, wrapped_key__isnull=False):
+        datakey = acl.unwrap_datakey(user_password=previous)
+        acl.wrap_datakey(datakey, user_password=instance.password)
+        PasswordFolderACL.objects.filter(pk=acl.pk).update(wrapped_key=acl.wrapped_key, kdf=acl.kdf)
+
+
+# Expire cached personal keys derived from a User's previous password
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def expire_personal_keys(sender, instance=None, **kwargs):
+    personalkey_cache.invalidate(instance.uuid, keep=instance.password)
+
+
+# Rank the stock access levels of databases created before AccessLevel.rank existed
+@receiver(post_migrate)
+def backfill_access_rank(sender, using='default', **kwargs):
+    if sender.label != 'core':
+        return
+    for name, rank in ACCESS_RANKS.items():
+        AccessLevel.objects.using(using).filter(name=name, rank=0).update(rank=rank)
+    access_levels.invalidate()
 
 
 class User(AbstractBaseUser, PermissionsMixin):
@@ -64,8 +96,14 @@ class User(AbstractBaseUser, PermissionsMixin):
 
 
 class AccessLevel(models.Model):
+    OWNER = ACCESS_RANKS['Owner']
+    ADMIN = ACCESS_RANKS['Admin']
+    MODIFY = ACCESS_RANKS['Modify']
+    READ = ACCESS_RANKS['Read']
+
     name = models.CharField(max_length=100)
     description = models.CharField(max_length=1024)
+    rank = models.PositiveSmallIntegerField(default=0)  # higher is stronger, checks use level__rank__gte
 
     class Meta:
         db_table = 'auth_accesslevel'
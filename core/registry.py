@@ -0,0 +1,64 @@
+import threading
+
+from django.apps import apps
+from django.db.models.signals import post_delete, post_save
+
+
+class ReferenceRegistry(object):
+    """
+    Process-wide copy of a small reference table, served by id and by name.
+
+    The table is loaded once on first use and dropped whenever one of its rows is saved or deleted in this process;
+    a row added by another process is picked up by the first lookup that misses it.
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.lock = threading.Lock()
+        self.by_pk = None
+        self.by_name = None
+        post_save.connect(self.invalidate, sender=label, weak=False)
+        post_delete.connect(self.invalidate, sender=label, weak=False)
+
+    @property
+    def model(self):
+        return apps.get_model(self.label)
+
+    def load(self):
+        with self.lock:
+            if self.by_pk is None:
+                rows = list(self.model.objects.order_by('pk'))
+                self.by_name = {row.name: row for row in rows}
+                self.by_pk = {row.pk: row for row in rows}
+            return self.by_pk, self.by_name
+
+    def all(self):
+        return list(self.load()[0].values())
+
+    def get(self, pk=None, name=None):
+        """
+        Return the row with `pk` or `name`; raises the model's DoesNotExist like objects.get().
+
+        A miss reloads the table once before raising, for rows written by another process.
+        """
+        for reload in (False, True):
+            if reload:
+                self.invalidate()
+            by_pk, by_name = self.load()
+            try:
+                return by_pk[int(pk)] if pk is not None else by_name[name]
+            except (TypeError, ValueError):
+                break
+            except KeyError:
+                pass
+        raise self.model.DoesNotExist('{} matching pk={!r} name={!r} does not exist'.format(self.label, pk, name))
+
+    def invalidate(self, **kwargs):
+        with self.lock:
+            self.by_pk = None
+            self.by_name = None
+
+
+access_levels = ReferenceRegistry('core.AccessLevel')
+owners = ReferenceRegistry('core.Owner')
+password_types = ReferenceRegistry('passwords.PasswordType')
@@ -0,0 +1,59 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def encode_default(obj):
+    # dates, uuids, decimals and the like are encoded as in JSON responses
+    return JSONEncoder().default(obj)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer encoding with ujson when it is installed, the stock encoder otherwise.
+
+    Indented (?indent= or Accept indent) responses and data ujson cannot encode go through the stock encoder.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if ujson is None or data is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super(FastJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+        try:
+            return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+        except (TypeError, OverflowError):
+            return super(FastJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        assert msgpack is not None, 'MessagePackRenderer requires msgpack to be installed'
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=encode_default, use_bin_type=True)
+
+
+class MessagePackParser(BaseParser):
+    media_type = 'application/msgpack'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        assert msgpack is not None, 'MessagePackParser requires msgpack to be installed'
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except Exception as exc:
+            raise ParseError('MessagePack parse error - %s' % exc)
@@ -0,0 +1,23 @@
+from django.db import connections
+from django.db.models import Case, Value, When
+from django.db.models.functions import Cast
+
+
+def bulk_update(model, objs, fields):
+    """
+    Write `fields` of every object in `objs` with a single UPDATE statement.
+
+    Stands in for QuerySet.bulk_update, which is not available before Django 2.2.
+    """
+    if not objs:
+        return 0
+    # PostgreSQL types a CASE from its branches, so one whose values are all NULL comes out as text and the
+    # column rejects it; cast every CASE to its column type there, as QuerySet.bulk_update does
+    requires_casting = connections[model.objects.db].vendor == 'postgresql'
+    updates = {}
+    for name in fields:
+        field = model._meta.get_field(name)
+        whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in objs]
+        case = Case(*whens, output_field=field)
+        updates[field.attname] = Cast(case, output_field=field) if requires_casting else case
+    return model.objects.filter(pk__in=[obj.pk for obj in objs]).update(**updates)
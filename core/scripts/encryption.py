@@ -1,55 +1,293 @@
 import base64
+import hashlib
+import os
+import threading
+import time
 import uuid
-from cryptography.fernet import Fernet
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+
+# KDF that derived every key before the algorithm and parameters were stored with them
+LEGACY_KDF = 'pbkdf2-sha256$iterations=100000'
+
+# first byte of every AEAD ciphertext: version, then a 12 byte nonce, then the AES-GCM ciphertext and tag
+AEAD_VERSION = b'\x01'
 
 
 def generate_uuid():
     list_uuid = uuid.uuid4()
     return list_uuid
 
-def generate_masterkey(domain):
+def generate_key_id(key):
+    return hashlib.sha256(key).hexdigest()[:16]
+
+class PBKDF2KDF(object):
+    name = 'pbkdf2-sha256'
+
+    def __init__(self, iterations=100000):
+        self.iterations = int(iterations)
+
+    @property
+    def params(self):
+        return {'iterations': self.iterations}
+
+    def derive(self, password, salt):
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            iterations=self.iterations,
+            backend=default_backend()
+        )
+        return kdf.derive(password)
+
+
+class ScryptKDF(object):
+    name = 'scrypt'
+
+    def __init__(self, n=2 ** 14, r=8, p=1):
+        self.n = int(n)
+        self.r = int(r)
+        self.p = int(p)
+
+    @property
+    def params(self):
+        return {'n': self.n, 'r': self.r, 'p': self.p}
+
+    def derive(self, password, salt):
+        kdf = Scrypt(salt=salt, length=32, n=self.n, r=self.r, p=self.p, backend=default_backend())
+        return kdf.derive(password)
+
+
+KDFS = {kdf.name: kdf for kdf in (PBKDF2KDF, ScryptKDF)}
+
+def get_kdf(descriptor=None):
+    """
+    Build a KDF from a descriptor such as 'scrypt$n=16384,r=8,p=1'; defaults to the KDF setting.
+    """
+    if descriptor is None:
+        descriptor = getattr(settings, 'KDF', LEGACY_KDF)
+    name, _, params = descriptor.partition('$')
+    try:
+        kdf = KDFS[name]
+    except KeyError:
+        raise ValueError('Unknown KDF {!r}'.format(name))
+    return kdf(**dict(param.split('=', 1) for param in params.split(',') if param))
+
+def kdf_descriptor(kdf):
+    return '{}${}'.format(kdf.name, ','.join('{}={}'.format(k, v) for k, v in sorted(kdf.params.items())))
+
+def current_kdf():
+    return kdf_descriptor(get_kdf())
+
+def generate_masterkey(domain, globalkey=None, kdf=None):
     domain = str(uuid.uuid5(uuid.NAMESPACE_DNS, domain))
     domain = domain.encode('utf-8')
-    globalkey = settings.MASTER_SALT
+    if globalkey is None:
+        globalkey = settings.MASTER_SALT
     salt = globalkey.encode('utf-8')
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=100000,
-        backend=default_backend()
-    )
-    masterkey = base64.urlsafe_b64encode(kdf.derive(domain))
+    if kdf is None:
+        kdf = getattr(settings, 'MASTER_KDF', LEGACY_KDF)
+    masterkey = base64.urlsafe_b64encode(get_kdf(kdf).derive(domain, salt))
     return masterkey
 
-def generate_personalkey(user_uuid, user_password):
+
+def master_salt_entry(entry):
+    """
+    Return (salt, KDF descriptor) of a master salt setting entry: a plain salt, derived with MASTER_KDF (None),
+    or a {'salt', 'kdf'} mapping or (salt, kdf) pair for a salt whose master key used another KDF.
+    """
+    if isinstance(entry, str):
+        return entry, None
+    if isinstance(entry, dict):
+        return entry['salt'], entry.get('kdf')
+    salt, kdf = entry
+    return salt, kdf
+
+
+class MasterKeyProvider(object):
+    """
+    Derives the master key once per process and keeps the ready Fernet around.
+
+    `salts` defaults to MASTER_SALT followed by MASTER_SALT_PREVIOUS, each derived with its own KDF. Tokens from
+    any of them decrypt, new tokens always use the first one.
+    """
+
+    def __init__(self, domain, salts=None, kdf=None):
+        self.domain = domain
+        self._salts = salts
+        self.kdf = kdf
+        self._keys = None
+        self._fernet = None
+        self._lock = threading.Lock()
+
+    @property
+    def salts(self):
+        """
+        (salt, KDF descriptor) pairs, current first; a None KDF is `kdf` or MASTER_KDF.
+        """
+        if self._salts is None:
+            salts = [settings.MASTER_SALT] + list(getattr(settings, 'MASTER_SALT_PREVIOUS', []))
+        else:
+            salts = self._salts
+        return [master_salt_entry(entry) for entry in salts]
+
+    @property
+    def keys(self):
+        if self._keys is None:
+            with self._lock:
+                if self._keys is None:
+                    self._keys = [generate_masterkey(self.domain, salt, kdf or self.kdf) for salt, kdf in self.salts]
+        return self._keys
+
+    @property
+    def key(self):
+        return self.keys[0]
+
+    @property
+    def key_id(self):
+        return generate_key_id(self.key)
+
+    def get_fernet(self, key_id):
+        """
+        Return the Fernet of the master key with `key_id`, or all known keys when it is unknown.
+        """
+        for key in self.keys:
+            if key_id and generate_key_id(key) == key_id:
+                return Fernet(key)
+        return self.fernet
+
+    @property
+    def fernet(self):
+        if self._fernet is None:
+            keys = self.keys
+            with self._lock:
+                if self._fernet is None:
+                    if len(keys) == 1:
+                        self._fernet = Fernet(keys[0])
+                    else:
+                        self._fernet = MultiFernet([Fernet(key) for key in keys])
+        return self._fernet
+
+    def reset(self):
+        with self._lock:
+            self._keys = None
+            self._fernet = None
+
+
+masterkey_provider = MasterKeyProvider('28beatty')
+
+def generate_personalkey(user_uuid, user_password, kdf=None):
     password = user_password.encode('utf-8')
     salt = str(user_uuid)
     salt = salt.encode('utf-8')
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=100000,
-        backend=default_backend()
-    )
-    personalkey = base64.urlsafe_b64encode(kdf.derive(password))
+    personalkey = base64.urlsafe_b64encode(get_kdf(kdf).derive(password, salt))
     return personalkey
 
+
+class PersonalKeyCache(object):
+    """
+    Bounded LRU/TTL cache of personal keys keyed on user uuid, password hash and KDF.
+
+    Size and TTL default to PERSONALKEY_CACHE_SIZE and PERSONALKEY_CACHE_TTL.
+    """
+
+    def __init__(self, maxsize=None, ttl=None):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        if self._maxsize is None:
+            return getattr(settings, 'PERSONALKEY_CACHE_SIZE', 1024)
+        return self._maxsize
+
+    @property
+    def ttl(self):
+        if self._ttl is None:
+            return getattr(settings, 'PERSONALKEY_CACHE_TTL', 3600)
+        return self._ttl
+
+    def _cache_key(self, user_uuid, user_password, kdf=None):
+        return str(user_uuid), hashlib.sha256(user_password.encode('utf-8')).hexdigest(), kdf
+
+    def get(self, user_uuid, user_password, kdf=None):
+        if kdf is None:
+            kdf = getattr(settings, 'KDF', LEGACY_KDF)
+        cache_key = self._cache_key(user_uuid, user_password, kdf)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is not None and (not self.ttl or now - entry[1] < self.ttl):
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        personalkey = generate_personalkey(user_uuid, user_password, kdf)
+        with self._lock:
+            self._entries[cache_key] = (personalkey, now)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > max(self.maxsize, 0):
+                self._entries.popitem(last=False)
+        return personalkey
+
+    def invalidate(self, user_uuid, keep=None):
+        """
+        Drop the cached keys of a user, except the one matching the password hash in `keep`.
+        """
+        user_uuid = str(user_uuid)
+        keep_hash = self._cache_key(user_uuid, keep)[1] if keep is not None else None
+        with self._lock:
+            for cache_key in list(self._entries):
+                if cache_key[0] == user_uuid and cache_key[1] != keep_hash:
+                    del self._entries[cache_key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._entries),
+                    'maxsize': self.maxsize,
+                    'ttl': self.ttl}
+
+
+personalkey_cache = PersonalKeyCache()
+
+def get_fernet(key):
+    if isinstance(key, (Fernet, MultiFernet)):
+        return key
+    return Fernet(key)
+
 def encrypt_password(masterkey, personalkey, password):
 
     ## encrypt using master key
-    f = Fernet(masterkey)
+    f = get_fernet(masterkey)
     pwbin = password.encode('utf-8')
     pwenc = f.encrypt(pwbin)
     pw = pwenc.decode('utf-8')
 
     ## encrypt using personal key
-    fn = Fernet(personalkey)
+    fn = get_fernet(personalkey)
     finpwbin = pw.encode('utf-8')
     finpwenc = fn.encrypt(finpwbin)
 
@@ -59,15 +297,147 @@ def encrypt_password(masterkey, personalkey, password):
 def decrypt_password(masterkey, personalkey, password):
 
     ## decrypt using personal key
-    f = Fernet(personalkey)
+    f = get_fernet(personalkey)
     pw1 = password.encode('utf-8')
     pw = f.decrypt(pw1)
 
     ## decrypt using master key
-    f = Fernet(masterkey)
+    f = get_fernet(masterkey)
     pw = f.decrypt(pw)
     try:
         pw = pw.decode('utf-8')
     except:
         pass
     return pw
+
+def rotate_password(old_masterkey, new_masterkey, personalkey, password):
+    personal = get_fernet(personalkey)
+    pw = get_fernet(old_masterkey).decrypt(personal.decrypt(password.encode('utf-8')))
+    return personal.encrypt(get_fernet(new_masterkey).encrypt(pw)).decode('utf-8')
+
+def generate_datakey():
+    return Fernet.generate_key()
+
+def wrap_datakey(masterkey, personalkey, datakey):
+    return encrypt_password(masterkey, personalkey, datakey.decode('utf-8'))
+
+def unwrap_datakey(masterkey, personalkey, wrapped_key):
+    return decrypt_password(masterkey, personalkey, wrapped_key).encode('utf-8')
+
+def encrypt_secret(datakey, secret):
+    return get_fernet(datakey).encrypt(secret.encode('utf-8')).decode('utf-8')
+
+def decrypt_secret(datakey, secret):
+    return get_fernet(datakey).decrypt(secret.encode('utf-8')).decode('utf-8')
+
+def combine_keys(masterkey, datakey):
+    """
+    Derive the AES-GCM key that replaces encrypting with both the master key and a folder data key.
+    """
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b'enterpass-aead-v1',
+                backend=default_backend())
+    return hkdf.derive(base64.urlsafe_b64decode(masterkey) + base64.urlsafe_b64decode(datakey))
+
+def get_aead(key):
+    if isinstance(key, AESGCM):
+        return key
+    return AESGCM(key)
+
+def encrypt_aead(key, secret):
+    nonce = os.urandom(12)
+    return AEAD_VERSION + nonce + get_aead(key).encrypt(nonce, secret.encode('utf-8'), AEAD_VERSION)
+
+def decrypt_aead(key, secret):
+    secret = bytes(secret)
+    if secret[:1] != AEAD_VERSION:
+        raise InvalidToken
+    try:
+        return get_aead(key).decrypt(secret[1:13], secret[13:], AEAD_VERSION).decode('utf-8')
+    except InvalidTag:
+        raise InvalidToken
+
+
+class KeyContext(object):
+    """
+    Keys of one user for the duration of a request: personal keys per KDF and unwrapped folder keys.
+
+    Build it with `get_key_context(request)` so every serializer of the request shares it.
+    """
+
+    def __init__(self, user):
+        self.user = user
+        self._folders = {}
+
+    def personalkey(self, kdf=None):
+        return personalkey_cache.get(self.user.uuid, self.user.password, kdf)
+
+    def get_folder_keys(self, folder):
+        """
+        Return `folder`'s data key with its Fernet and key id, unwrapped once per request.
+
+        Re-raises the DoesNotExist of `folder.get_datakey` when the user holds no ACL on the folder.
+        """
+        if folder.pk not in self._folders:
+            try:
+                datakey = folder.get_datakey(self.user)
+                self._folders[folder.pk] = {'datakey': datakey,
+                                            'fernet': get_fernet(datakey),
+                                            'key_id': generate_key_id(datakey)}
+            except ObjectDoesNotExist as e:
+                self._folders[folder.pk] = e.__class__
+        keys = self._folders[folder.pk]
+        if isinstance(keys, type):
+            raise keys
+        return keys
+
+    def get_aead_keys(self, folder):
+        """
+        Return (key id, AESGCM) pairs of `folder`, one per known master key, current master key first.
+        """
+        keys = self.get_folder_keys(folder)
+        if 'aead' not in keys:
+            keys['aead'] = []
+            for masterkey in masterkey_provider.keys:
+                aead_key = combine_keys(masterkey, keys['datakey'])
+                keys['aead'].append((generate_key_id(aead_key), get_aead(aead_key)))
+        return keys['aead']
+
+def get_key_context(request):
+    context = getattr(request, 'key_context', None)
+    if context is None or context.user != request.user:
+        context = KeyContext(request.user)
+        request.key_context = context
+    return context
+
+
+_decrypt_pool = None
+_decrypt_pool_lock = threading.Lock()
+
+def get_decrypt_pool():
+    global _decrypt_pool
+    if _decrypt_pool is None:
+        with _decrypt_pool_lock:
+            if _decrypt_pool is None:
+                _decrypt_pool = ThreadPoolExecutor(max_workers=getattr(settings, 'DECRYPT_WORKERS', 4),
+                                                   thread_name_prefix='decrypt')
+    return _decrypt_pool
+
+def _decrypt_or_none(job):
+    decrypt, key, secret = job
+    try:
+        return decrypt(key, secret)
+    except InvalidToken:
+        return None
+
+def decrypt_secrets(jobs, pool=None):
+    """
+    Decrypt a batch of (decrypt_secret or decrypt_aead, key, secret) jobs, returning None for secrets the
+    key cannot open.
+
+    Without an explicit `pool`, batches smaller than DECRYPT_BATCH_MIN stay on the calling thread.
+    """
+    if pool is None:
+        if getattr(settings, 'DECRYPT_WORKERS', 4) <= 1 or len(jobs) < getattr(settings, 'DECRYPT_BATCH_MIN', 64):
+            return [_decrypt_or_none(job) for job in jobs]
+        pool = get_decrypt_pool()
+    return list(pool.map(_decrypt_or_none, jobs))
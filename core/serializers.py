@@ -2,6 +2,35 @@ from core.models import User, AccessLevel, Owner
 from rest_framework import serializers
 
 
+def sparse_fields(request, fields):
+    """
+    Return `fields` narrowed down by the comma separated ?fields= and ?exclude= of a GET `request`.
+    """
+    if request is None or request.method != 'GET':
+        return list(fields)
+    params = request.query_params
+    if params.get('fields'):
+        keep = params['fields'].split(',')
+        fields = [field for field in fields if field in keep]
+    if params.get('exclude'):
+        drop = params['exclude'].split(',')
+        fields = [field for field in fields if field not in drop]
+    return list(fields)
+
+
+class SparseFieldsMixin(object):
+    """
+    Serialize only the fields selected with ?fields= and ?exclude= on GET requests.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SparseFieldsMixin, self).__init__(*args, **kwargs)
+        keep = sparse_fields(self.context.get('request'), self.fields)
+        for field in list(self.fields):
+            if field not in keep:
+                self.fields.pop(field)
+
+
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
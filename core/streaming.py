@@ -0,0 +1,38 @@
+import json
+
+from django.conf import settings
+from django.db.models import prefetch_related_objects
+from django.http import StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+
+
+def iterate_chunks(queryset, chunk_size=None, prefetch=()):
+    """
+    Yield `queryset` in lists of `chunk_size` rows read through a server side cursor, prefetching `prefetch`
+    per chunk since iterator() ignores prefetch_related().
+    """
+    chunk_size = chunk_size or getattr(settings, 'STREAM_CHUNK_SIZE', 500)
+    chunk = []
+    for obj in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(obj)
+        if len(chunk) == chunk_size:
+            prefetch_related_objects(chunk, *prefetch)
+            yield chunk
+            chunk = []
+    if chunk:
+        prefetch_related_objects(chunk, *prefetch)
+        yield chunk
+
+def stream_json_list(chunks, serialize):
+    """
+    Return a response writing a JSON array item by item, `serialize` turning each chunk into a list of dicts.
+    """
+    def content():
+        separator = '['
+        for chunk in chunks:
+            for item in serialize(chunk):
+                yield separator + json.dumps(item, cls=JSONEncoder, ensure_ascii=False)
+                separator = ','
+        yield '[]' if separator == '[' else ']'
+
+    return StreamingHttpResponse(content(), content_type='application/json')
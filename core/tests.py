@@ -1,8 +1,24 @@
+import json
+from io import BytesIO, StringIO
+from unittest import mock
+from uuid import uuid4
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, override_settings
 from django.urls import reverse
 from rest_framework import status
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
 from rest_framework.test import force_authenticate, APITestCase, APIClient, APIRequestFactory
-from core.models import User, AccessLevel, Owner
+from core.models import User, AccessLevel, Owner, SystemSetting
+from core.registry import access_levels
+from core.renderers import FastJSONRenderer, MessagePackParser, MessagePackRenderer
+from core.scripts import encryption
 from core.views import UserViewSet, AccessLevelViewSet, OwnerViewSet
+from passwordfolders.models import PasswordFolder
+from passwords.models import Password
+from passwords.serializers import PasswordSerializer
 
 
 class AuthAPITestCase(APITestCase):
@@ -105,6 +121,7 @@ class AccessLevelAPITestCase(APITestCase):
         force_authenticate(request, user=user)
         response = view(request)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('max-age=86400', response['Cache-Control'])
 
     # List Access Levels as Test User
     def test_accesslevel_list_user(self):
@@ -191,3 +208,269 @@ class OwnerAPITestCase(APITestCase):
         response = view(request, pk=1)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+
+class MasterKeyProviderTestCase(SimpleTestCase):
+
+    # Master key is derived once and the Fernet is reused
+    def test_masterkey_derived_once(self):
+        provider = encryption.MasterKeyProvider('28beatty')
+        with mock.patch.object(encryption, 'generate_masterkey',
+                               wraps=encryption.generate_masterkey) as derive:
+            fernet = provider.fernet
+            self.assertIs(provider.fernet, fernet)
+            self.assertIsNotNone(provider.key)
+        self.assertEqual(derive.call_count, 1)
+        token = encryption.encrypt_password(fernet, encryption.generate_personalkey('uuid', 'hash'), 'secret')
+        self.assertEqual(encryption.decrypt_password(provider.key, encryption.generate_personalkey('uuid', 'hash'), token),
+                         'secret')
+
+
+class PersonalKeyCacheTestCase(SimpleTestCase):
+
+    # Repeated lookups hit the cache and the size bound evicts the oldest user
+    def test_personalkey_cache_hits_and_evicts(self):
+        cache = encryption.PersonalKeyCache(maxsize=1, ttl=0)
+        key = cache.get('first', 'hash')
+        self.assertEqual(cache.get('first', 'hash'), key)
+        cache.get('second', 'hash')
+        cache.get('first', 'hash')
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 3)
+        self.assertEqual(cache.stats()['size'], 1)
+
+    # Entries expire after the TTL
+    def test_personalkey_cache_ttl(self):
+        cache = encryption.PersonalKeyCache(maxsize=8, ttl=60)
+        with mock.patch.object(encryption.time, 'monotonic', return_value=0):
+            cache.get('first', 'hash')
+        with mock.patch.object(encryption.time, 'monotonic', return_value=61):
+            cache.get('first', 'hash')
+        self.assertEqual(cache.stats()['misses'], 2)
+
+
+class PersonalKeyInvalidationTestCase(APITestCase):
+    fixtures = ['owner.yaml', 'passwordtype.yaml', 'accesslevel.yaml']
+
+    # Changing a User's password drops the key derived from the old hash
+    def test_password_change_invalidates(self):
+        user = User.objects.create_user(username='regular', password='Welcome2', email='regular@user.com')
+        cache = encryption.personalkey_cache
+        cache.clear()
+        cache.get(user.uuid, user.password)
+        user.set_password('Welcome3')
+        user.save()
+        self.assertEqual(cache.stats()['size'], 0)
+        cache.get(user.uuid, user.password)
+        self.assertEqual(cache.stats()['misses'], 2)
+
+
+class RotateMasterKeyTestCase(APITestCase):
+    fixtures = ['owner.yaml', 'passwordtype.yaml', 'accesslevel.yaml']
+
+    def tearDown(self):
+        encryption.masterkey_provider.reset()
+
+    def use_salts(self, salt, previous=(), kdf=encryption.LEGACY_KDF):
+        settings = override_settings(MASTER_SALT=salt, MASTER_SALT_PREVIOUS=list(previous), MASTER_KDF=kdf)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        encryption.masterkey_provider.reset()
+
+    # Wrapped folder keys, AEAD and legacy passwords are re-encrypted with the new salt
+    def test_rotate_masterkey(self):
+        self.use_salts('old-salt')
+        user = User.objects.create_user(username='regular', password='Welcome2', email='regular@user.com')
+        folder = PasswordFolder.objects.get(user=user)
+        folder.share_datakey()
+        datakey = encryption.get_fernet(folder.get_datakey(user)).encrypt(b'check')
+        personalkey = encryption.personalkey_cache.get(user.uuid, user.password, encryption.LEGACY_KDF)
+        Password.objects.create(name='Legacy', description='Legacy Password', username='legacy', folder=folder,
+                                password=encryption.encrypt_password(encryption.masterkey_provider.fernet,
+                                                                     personalkey, 'legacy'))
+        aead_key = encryption.combine_keys(encryption.masterkey_provider.key, folder.get_datakey(user))
+        Password.objects.create(name='AEAD', description='AEAD Password', username='aead', folder=folder,
+                                password='', secret=encryption.encrypt_aead(aead_key, 'aead'),
+                                scheme=Password.SCHEME_AEAD, key_id=encryption.generate_key_id(aead_key))
+
+        self.use_salts('new-salt', previous=['old-salt'])
+        call_command('rotate_masterkey', chunk_size=1, stdout=StringIO())
+        self.assertFalse(SystemSetting.objects.filter(name__startswith='masterkey-rotation').exists())
+
+        self.use_salts('new-salt')
+        self.assertEqual(encryption.get_fernet(folder.get_datakey(user)).decrypt(datakey), b'check')
+        self.assertEqual(encryption.decrypt_password(encryption.masterkey_provider.fernet, personalkey,
+                                                     Password.objects.get(name='Legacy').password), 'legacy')
+        aead = Password.objects.get(name='AEAD')
+        aead_key = encryption.combine_keys(encryption.masterkey_provider.key, folder.get_datakey(user))
+        self.assertEqual(aead.key_id, encryption.generate_key_id(aead_key))
+        self.assertEqual(encryption.decrypt_aead(aead_key, aead.secret), 'aead')
+
+    # Rows no holder key opens are reported and keep the old salt needed; rotated rows are not reported again
+    def test_rotate_masterkey_skipped_rows(self):
+        self.use_salts('old-salt')
+        user = User.objects.create_user(username='regular', password='Welcome2', email='regular@user.com')
+        folder = PasswordFolder.objects.get(user=user)
+        folder.share_datakey()
+        personalkey = encryption.personalkey_cache.get(user.uuid, user.password, encryption.LEGACY_KDF)
+        for name, key in (('Legacy', personalkey), ('Orphan', encryption.generate_datakey())):
+            Password.objects.create(name=name, description='Legacy Password', username='legacy', folder=folder,
+                                    password=encryption.encrypt_password(encryption.masterkey_provider.fernet,
+                                                                         key, 'legacy'))
+
+        self.use_salts('new-salt', previous=['old-salt'])
+        stdout, stderr = StringIO(), StringIO()
+        with self.assertRaisesMessage(CommandError, '1 password'):
+            call_command('rotate_masterkey', stdout=stdout, stderr=stderr)
+        self.assertNotIn('can now be removed', stdout.getvalue())
+        self.assertIn('pk {}'.format(Password.objects.get(name='Orphan').pk), stderr.getvalue())
+
+        Password.objects.filter(name='Orphan').delete()
+        stdout = StringIO()
+        call_command('rotate_masterkey', stdout=stdout, stderr=StringIO())
+        self.assertIn('0 skipped', stdout.getvalue())
+        self.assertIn('can now be removed', stdout.getvalue())
+
+    # Changing master-kdf keeps old rows readable through the previous {salt, kdf} entry until rotation
+    def test_master_kdf_change(self):
+        old_kdf = 'pbkdf2-sha256$iterations=1000'
+        new_kdf = 'pbkdf2-sha256$iterations=2000'
+        self.use_salts('salt', kdf=old_kdf)
+        user = User.objects.create_user(username='regular', password='Welcome2', email='regular@user.com')
+        folder = PasswordFolder.objects.get(user=user)
+        folder.share_datakey()
+        aead_key = encryption.combine_keys(encryption.masterkey_provider.key, folder.get_datakey(user))
+        Password.objects.create(name='AEAD', description='AEAD Password', username='aead', folder=folder,
+                                password='', secret=encryption.encrypt_aead(aead_key, 'aead'),
+                                scheme=Password.SCHEME_AEAD, key_id=encryption.generate_key_id(aead_key))
+
+        self.use_salts('salt', previous=[{'salt': 'salt', 'kdf': old_kdf}], kdf=new_kdf)
+        request = Request(APIRequestFactory().get('/'))
+        request.user = user
+        serializer = PasswordSerializer(Password.objects.get(name='AEAD'), context={'request': request})
+        self.assertEqual(serializer.data['password'], 'aead')
+
+        call_command('rotate_masterkey', chunk_size=1, stdout=StringIO())
+        self.use_salts('salt', kdf=new_kdf)
+        request.key_context = None
+        serializer = PasswordSerializer(Password.objects.get(name='AEAD'), context={'request': request})
+        self.assertEqual(serializer.data['password'], 'aead')
+
+
+class BenchmarkEncryptionTestCase(APITestCase):
+    fixtures = ['owner.yaml', 'accesslevel.yaml']
+
+    # The benchmark report is machine readable JSON
+    def test_benchmark_encryption_json(self):
+        output = StringIO()
+        call_command('benchmark_encryption', batch_sizes='2', threads='1,2', repeat=1, stdout=output)
+        results = json.loads(output.getvalue())['results']
+        self.assertEqual([r['threads'] for r in results if r['name'] == 'list_folderkey'], [1, 2])
+        self.assertTrue(all({'ops_per_sec', 'p50_ms', 'p99_ms'} <= set(r) for r in results))
+
+    # --round-trip times encrypt and list serialization through PasswordSerializer, seeding nothing for good
+    def test_benchmark_encryption_round_trip(self):
+        output = StringIO()
+        users = User.objects.count()
+        call_command('benchmark_encryption', batch_sizes='1,3', threads='1,2', repeat=1, round_trip=True,
+                     stdout=output)
+        results = json.loads(output.getvalue())['results']
+        self.assertEqual([(r['batch_size'], r['threads']) for r in results if r['name'] == 'round_trip_serializer'],
+                         [(1, 1), (1, 2), (3, 1), (3, 2)])
+        self.assertEqual(User.objects.count(), users)
+        self.assertFalse(PasswordFolder.objects.filter(name='Benchmark').exists())
+
+
+class KDFRegistryTestCase(SimpleTestCase):
+
+    # Descriptors round trip through the registry and default to the KDF setting
+    def test_kdf_descriptors(self):
+        kdf = encryption.get_kdf('scrypt$n=1024,r=8,p=1')
+        self.assertIsInstance(kdf, encryption.ScryptKDF)
+        self.assertEqual(encryption.kdf_descriptor(kdf), 'scrypt$n=1024,p=1,r=8')
+        with override_settings(KDF='pbkdf2-sha256$iterations=1000'):
+            self.assertEqual(encryption.current_kdf(), 'pbkdf2-sha256$iterations=1000')
+            self.assertNotEqual(encryption.generate_personalkey('uuid', 'hash'),
+                                encryption.generate_personalkey('uuid', 'hash', encryption.LEGACY_KDF))
+        with self.assertRaises(ValueError):
+            encryption.get_kdf('bcrypt$rounds=12')
+
+
+class RendererTestCase(SimpleTestCase):
+
+    # MessagePack round trips through the parser and fast JSON matches the stock renderer
+    def test_renderers_round_trip(self):
+        data = [{'id': 1, 'name': 'Test Password', 'uuid': uuid4(), 'tags': ['a', 'b'], 'url': 'http://x.com/'}]
+        expected = json.loads(JSONRenderer().render(data).decode('utf-8'))
+        self.assertEqual(json.loads(FastJSONRenderer().render(data).decode('utf-8')), expected)
+        packed = MessagePackRenderer().render(data)
+        self.assertEqual(MessagePackParser().parse(BytesIO(packed)), expected)
+        with self.assertRaises(ParseError):
+            MessagePackParser().parse(BytesIO(b'\xc1'))
+
+    # The renderer benchmark report is machine readable JSON
+    def test_benchmark_renderers_json(self):
+        output = StringIO()
+        call_command('benchmark_renderers', sizes='2', repeat=1, stdout=output)
+        results = json.loads(output.getvalue())['results']
+        self.assertEqual([r['name'] for r in results], ['json', 'fastjson', 'msgpack'])
+        self.assertTrue(all({'lists_per_sec', 'p50_ms', 'p99_ms', 'bytes'} <= set(r) for r in results))
+
+
+class BenchmarkQueriesTestCase(APITestCase):
+    fixtures = ['owner.yaml', 'accesslevel.yaml']
+
+    # The query benchmark seeds, reports plans and timings as JSON and rolls the seed back
+    def test_benchmark_queries_json(self):
+        output = StringIO()
+        call_command('benchmark_queries', rows=50, users=5, folders=5, repeat=2, stdout=output)
+        report = json.loads(output.getvalue())
+        self.assertEqual(len(report['results']), 6)
+        self.assertIn('has_access', [r['name'] for r in report['results']])
+        # an owner per personal folder plus five ACL holders per shared folder
+        self.assertEqual(report['access_rows'], 5 + 5 * 5)
+        self.assertTrue(all(r['plan'] for r in report['results']))
+        self.assertFalse(Password.objects.exists())
+
+
+class ReferenceRegistryTestCase(APITestCase):
+    fixtures = ['owner.yaml', 'passwordtype.yaml', 'accesslevel.yaml']
+
+    # Lookups by id and by name are served from memory once the table is loaded
+    def test_registry_lookups(self):
+        access_levels.invalidate()
+        owner = access_levels.get(name='Owner')
+        count = AccessLevel.objects.count()
+        with self.assertNumQueries(0):
+            self.assertEqual(access_levels.get(pk=owner.pk), owner)
+            self.assertEqual(access_levels.get(pk=str(owner.pk)).name, 'Owner')
+            self.assertEqual(len(access_levels.all()), count)
+        with self.assertRaises(AccessLevel.DoesNotExist):
+            access_levels.get(name='Nobody')
+
+    # Saving or deleting a row drops the cached table
+    def test_registry_invalidation(self):
+        level = access_levels.get(name='Read')
+        AccessLevel.objects.filter(pk=level.pk).update(description='changed')
+        self.assertNotEqual(access_levels.get(name='Read').description, 'changed')
+        level.description = 'saved'
+        level.save()
+        self.assertEqual(access_levels.get(name='Read').description, 'saved')
+        extra = AccessLevel.objects.create(name='Extra', description='extra')
+        self.assertEqual(access_levels.get(name='Extra'), extra)
+        extra.delete()
+        with self.assertRaises(AccessLevel.DoesNotExist):
+            access_levels.get(name='Extra')
+
+    # A row written by another process is loaded by the first lookup that misses it
+    def test_registry_reload_on_miss(self):
+        access_levels.get(name='Read')
+        AccessLevel.objects.bulk_create([AccessLevel(name='Elsewhere', description='another process')])
+        extra = AccessLevel.objects.get(name='Elsewhere')
+        with self.assertNumQueries(1):
+            self.assertEqual(access_levels.get(pk=extra.pk), extra)
+        with self.assertNumQueries(0):
+            self.assertEqual(access_levels.get(name='Elsewhere'), extra)
+        with self.assertNumQueries(1), self.assertRaises(AccessLevel.DoesNotExist):
+            access_levels.get(name='Nobody')
+        with self.assertNumQueries(0), self.assertRaises(AccessLevel.DoesNotExist):
+            access_levels.get(pk='x')
@@ -4,6 +4,8 @@ from rest_framework import status, viewsets
 from rest_framework.response import Response
 
 from core.models import User, AccessLevel, Owner, SystemSetting
+from core.conditional import set_reference_cache
+from core.pagination import ModifiedCursorPagination
 from core.permissions import (CanListUser,
                               CanRetrieveUser,
                               CanCreateUser,
@@ -20,12 +22,15 @@ from core.permissions import (CanListUser,
                               CanUpdateOwner,
                               CanDestroyOwner,
                               )
+from core.registry import access_levels, owners
 from core.serializers import UserSerializer, AccessLevelSerializer, OwnerSerializer
 
 
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
+    pagination_class = ModifiedCursorPagination
+    cursor_ordering = ('id',)
     permission_classes_by_action = {'list': [CanListUser],
                                     'create': [CanCreateUser],
                                     'retrieve': [CanRetrieveUser],
@@ -36,9 +41,9 @@ class UserViewSet(viewsets.ModelViewSet):
         try:
             queryset = self.get_queryset()
         except TypeError:
-            queryset = None
-        serializer = UserSerializer(queryset, many=True, context={'request': request})
-        return Response(serializer.data, status=status.HTTP_200_OK)
+            queryset = User.objects.none()
+        serializer = UserSerializer(self.paginate_queryset(queryset), many=True, context={'request': request})
+        return self.get_paginated_response(serializer.data)
 
     def create(self, request, **kwargs):
         try:
@@ -101,12 +106,8 @@ class AccessLevelViewSet(viewsets.ModelViewSet):
                                     'destroy': [CanDestroyAccessLevel]}
 
     def list(self, request, **kwargs):
-        try:
-            queryset = self.get_queryset()
-        except TypeError:
-            queryset = None
-        serializer = AccessLevelSerializer(queryset, many=True, context={'request': request})
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        serializer = AccessLevelSerializer(access_levels.all(), many=True, context={'request': request})
+        return set_reference_cache(Response(serializer.data, status=status.HTTP_200_OK))
 
     def retrieve(self, request, pk=None, **kwargs):
         try:
@@ -136,12 +137,8 @@ class OwnerViewSet(viewsets.ModelViewSet):
                                     'destroy': [CanDestroyOwner]}
 
     def list(self, request, **kwargs):
-        try:
-            queryset = self.get_queryset()
-        except TypeError:
-            queryset = None
-        serializer = OwnerSerializer(queryset, many=True, context={'request': request})
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        serializer = OwnerSerializer(owners.all(), many=True, context={'request': request})
+        return set_reference_cache(Response(serializer.data, status=status.HTTP_200_OK))
 
     def retrieve(self, request, pk=None, **kwargs):
         try:
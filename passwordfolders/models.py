@@ -1,8 +1,28 @@
-from django.db import models
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db import models, transaction
+from django.db.models import ProtectedError
+from django.db.models.signals import pre_save, post_delete, post_save
+from django.dispatch import receiver
 from mptt.models import MPTTModel, TreeForeignKey
 from taggit.managers import TaggableManager
 from uuid import uuid4
 
+from core.scripts.encryption import (current_kdf,
+                                     generate_datakey,
+                                     LEGACY_KDF,
+                                     masterkey_provider,
+                                     personalkey_cache,
+                                     unwrap_datakey,
+                                     wrap_datakey)
+from core.registry import access_levels
+
+# rank of the stock access levels, higher is stronger; the effective access on a folder is the strongest level
+# granted on it or an ancestor, and checks compare ranks in SQL with level__rank__gte
+ACCESS_RANKS = {'Owner': 40, 'Admin': 30, 'Modify': 20, 'Read': 10}
+
 
 class PasswordFolder(MPTTModel):
     name = models.CharField(max_length=100, null=False, blank=False)
@@ -21,18 +41,324 @@ class PasswordFolder(MPTTModel):
     class Meta:
         db_table = 'enterpass_passwordfolder'
         managed = True
+        # cursor pagination order; personal folder lookup, which would be a partial index on personal=True
+        # if Django supported conditions on indexes
+        indexes = [models.Index(fields=['modified', 'id'], name='passwordfolder_modified_id'),
+                   models.Index(fields=['user', 'personal'], name='passwordfolder_user_personal')]
 
     def __str__(self):
         return self.name
 
+    def get_datakey(self, user):
+        """
+        Return this folder's data key, unwrapped with the keys of `user`.
+
+        Users with access inherited from a parent folder, or granted a password of the folder through a password
+        ACL, read the key through one of its ACL holders; the password list and permissions still limit which rows
+        they can open with it. Raises PasswordFolderACL.DoesNotExist when `user` has no access to the folder.
+        """
+        try:
+            acl = PasswordFolderACL.objects.select_related('user').get(folder=self, user=user)
+        except PasswordFolderACL.DoesNotExist:
+            if not PasswordFolderAccess.objects.filter(folder=self, user=user).exists() and \
+                    not self.password_set.filter(passwordacl__user=user).exists():
+                raise
+            datakey = self.unwrap_any_datakey()
+            if datakey is None:
+                self.share_datakey()
+                datakey = self.unwrap_any_datakey()
+            if datakey is None:
+                raise
+            return datakey
+        if not acl.wrapped_key:
+            self.share_datakey()
+            acl.refresh_from_db(fields=['wrapped_key', 'kdf'])
+        datakey = acl.unwrap_datakey()
+        if acl.kdf != current_kdf():
+            # wrapped with outdated KDF parameters: upgrade on read
+            acl.wrap_datakey(datakey)
+            PasswordFolderACL.objects.filter(pk=acl.pk).update(wrapped_key=acl.wrapped_key, kdf=acl.kdf)
+        return datakey
+
+    def unwrap_any_datakey(self):
+        """
+        Return the data key through any ACL holder, or None when it has never been generated.
+        """
+        holder = PasswordFolderACL.objects.select_related('user').filter(folder=self, wrapped_key__isnull=False).first()
+        return holder.unwrap_datakey() if holder else None
+
+    def get_key_holders(self):
+        """
+        Return the users whose personal keys may have encrypted this folder's secrets: the folder's user
+        followed by its ACL holders.
+        """
+        users = [acl.user for acl in PasswordFolderACL.objects.filter(folder=self).select_related('user')]
+        if self.user is not None:
+            users.insert(0, self.user)
+        return users
+
+    def share_datakey(self):
+        """
+        Wrap the folder's data key for every ACL holder missing it, generating the key on first use.
+
+        A folder without ACLs gets no key: one wrapped for nobody would lock its secrets away for good.
+        """
+        with transaction.atomic():
+            acls = list(PasswordFolderACL.objects.select_for_update().select_related('user').filter(folder=self))
+            if not acls:
+                return
+            holders = [acl for acl in acls if acl.wrapped_key]
+            datakey = holders[0].unwrap_datakey() if holders else generate_datakey()
+            for acl in acls:
+                if not acl.wrapped_key:
+                    acl.wrap_datakey(datakey)
+                    PasswordFolderACL.objects.filter(pk=acl.pk).update(wrapped_key=acl.wrapped_key, kdf=acl.kdf)
+
+    def keep_datakey(self, acls, user):
+        """
+        Keep the data key wrapped for someone before the ACLs of this folder in `acls` (a queryset) are deleted.
+
+        When they hold every wrapped copy and the folder has passwords, the key is wrapped for `user` instead, on
+        their direct ACL or a new one at their effective level. Raises ProtectedError when `user` is losing their
+        own ACL or has no access to the folder.
+        """
+        acls = acls.filter(folder=self)
+        holders = PasswordFolderACL.objects.filter(folder=self, wrapped_key__isnull=False)
+        if not self.password_set.exists() or not holders.exists() or \
+                holders.exclude(pk__in=acls.values('pk')).exists():
+            return
+        access = PasswordFolderAccess.objects.filter(folder=self, user=user).first()
+        if access is None or acls.filter(user=user).exists():
+            raise ProtectedError('The last wrapped data key of folder {} cannot be deleted.'.format(self.pk),
+                                 list(acls))
+        datakey = self.unwrap_any_datakey()
+        acl = PasswordFolderACL.objects.filter(folder=self, user=user).select_related('user').first() or \
+            PasswordFolderACL(folder=self, user=user, level_id=access.level_id)
+        acl.wrap_datakey(datakey)
+        acl.save()
+
 
 class PasswordFolderACL(models.Model):
     user = models.ForeignKey('core.User', on_delete=models.PROTECT)
     folder = models.ForeignKey(PasswordFolder, on_delete=models.PROTECT)
     level = models.ForeignKey('core.AccessLevel', on_delete=models.PROTECT)
     key = models.UUIDField(default=uuid4, unique=True)
+    wrapped_key = models.TextField(null=True, blank=True, default=None)
+    kdf = models.CharField(max_length=64, blank=True, default='')  # KDF of the personal key wrapping the data key
     modified = models.DateTimeField(auto_now=True, blank=False)
 
     class Meta:
         db_table = 'enterpass_passwordfolderacl'
         managed = True
+        # one ACL per user and folder; also the index of every permission check
+        unique_together = (('user', 'folder'),)
+        # cursor pagination order
+        indexes = [models.Index(fields=['modified', 'id'], name='passwordfolderacl_modified_id')]
+
+    def wrap_datakey(self, datakey, user_password=None):
+        user_password = self.user.password if user_password is None else user_password
+        self.kdf = current_kdf()
+        self.wrapped_key = wrap_datakey(masterkey_provider.fernet,
+                                        personalkey_cache.get(self.user.uuid, user_password, self.kdf),
+                                        datakey)
+
+    def unwrap_datakey(self, user_password=None):
+        user_password = self.user.password if user_password is None else user_password
+        return unwrap_datakey(masterkey_provider.fernet,
+                              personalkey_cache.get(self.user.uuid, user_password, self.kdf or LEGACY_KDF),
+                              self.wrapped_key)
+
+
+class PasswordFolderAccess(models.Model):
+    """
+    Effective access of a user on a folder, from their ACLs on the folder and its ancestors.
+
+    Maintained from PasswordFolderACL and PasswordFolder signals; rebuild_folder_access regenerates it.
+    """
+    user = models.ForeignKey('core.User', on_delete=models.CASCADE)
+    folder = models.ForeignKey(PasswordFolder, on_delete=models.CASCADE)
+    level = models.ForeignKey('core.AccessLevel', on_delete=models.CASCADE)
+
+    class Meta:
+        db_table = 'enterpass_passwordfolderaccess'
+        managed = True
+        unique_together = (('user', 'folder'),)
+
+
+def strongest_level(first, second):
+    if first is None:
+        return second
+    return second if second.rank > first.rank else first
+
+
+def refresh_access(folder, users=None):
+    """
+    Recompute the effective access on `folder` and its descendants, for `users` (ids) or everyone.
+    """
+    subtree = list(folder.get_descendants(include_self=True))
+    ancestors = list(folder.get_ancestors().values_list('pk', flat=True))
+    acls = PasswordFolderACL.objects.filter(folder_id__in=ancestors + [f.pk for f in subtree])
+    if users is not None:
+        acls = acls.filter(user_id__in=users)
+    granted = defaultdict(dict)
+    for acl in acls:
+        level = access_levels.get(pk=acl.level_id)
+        granted[acl.folder_id][acl.user_id] = strongest_level(granted[acl.folder_id].get(acl.user_id), level)
+
+    def inherit(levels, folder_id):
+        levels = dict(levels)
+        for user, level in granted[folder_id].items():
+            levels[user] = strongest_level(levels.get(user), level)
+        return levels
+
+    inherited = {}
+    for pk in ancestors:
+        inherited = inherit(inherited, pk)
+    # tree order: every parent is resolved before its children
+    effective = {}
+    for node in subtree:
+        effective[node.pk] = inherit(inherited if node.pk == folder.pk else effective[node.parent_id], node.pk)
+    with transaction.atomic():
+        stale = PasswordFolderAccess.objects.filter(folder__in=[f.pk for f in subtree])
+        if users is not None:
+            stale = stale.filter(user_id__in=users)
+        stale.delete()
+        PasswordFolderAccess.objects.bulk_create(
+            PasswordFolderAccess(user_id=user, folder_id=folder_id, level=level)
+            for folder_id, levels in effective.items() for user, level in levels.items())
+
+
+_deferred = threading.local()
+
+
+@contextmanager
+def deferred_access_refresh():
+    """
+    Collect the effective access refreshes of ACL changes and run them once per folder when the block succeeds.
+
+    Yields the pending {folder id: user ids} map, for bulk writes that bypass the ACL signals to add to.
+    """
+    pending = _deferred.pending = defaultdict(set)
+    try:
+        yield pending
+    finally:
+        _deferred.pending = None
+    folders = PasswordFolder.objects.in_bulk(list(pending))
+    for folder_id, users in pending.items():
+        if folder_id in folders:
+            refresh_access(folders[folder_id], users=users)
+
+
+def defer_access_refresh(folder_id, user_id):
+    pending = getattr(_deferred, 'pending', None)
+    if pending is None:
+        return False
+    pending[folder_id].add(user_id)
+    return True
+
+
+def has_access(user, folder_id, rank):
+    """
+    Return whether `user` has at least the access level `rank` on the folder, inherited access included.
+    """
+    if user is None or not user.is_authenticated:
+        return False
+    return PasswordFolderAccess.objects.filter(user=user, folder_id=folder_id, level__rank__gte=rank).exists()
+
+
+def get_acl_folders(request, rank=None):
+    """
+    Return the folders `request.user` has access to, optionally only those with at least the access level `rank`.
+
+    The queryset filters on a subquery, so building it costs nothing until it is evaluated, and it is memoized on
+    the request for every serializer that restricts a writable field with it.
+    """
+    cache = getattr(request, 'acl_folders', None)
+    if cache is None:
+        cache = request.acl_folders = {}
+    if rank not in cache:
+        access = PasswordFolderAccess.objects.filter(user=request.user)
+        if rank:
+            access = access.filter(level__rank__gte=rank)
+        cache[rank] = PasswordFolder.objects.filter(id__in=access.values('folder_id'))
+    return cache[rank]
+
+
+# Drop the wrapped data key when an ACL is moved to another user or folder
+@receiver(pre_save, sender=PasswordFolderACL)
+def reset_wrapped_key(sender, instance=None, raw=False, **kwargs):
+    if raw or instance.pk is None or not instance.wrapped_key:
+        return
+    previous = PasswordFolderACL.objects.filter(pk=instance.pk).values('user_id', 'folder_id').first()
+    if previous and (previous['user_id'], previous['folder_id']) != (instance.user_id, instance.folder_id):
+        instance.wrapped_key = None
+
+
+# Wrap the folder's existing data key for a new ACL holder
+@receiver(post_save, sender=PasswordFolderACL)
+def grant_wrapped_key(sender, instance=None, raw=False, **kwargs):
+    if raw or instance.wrapped_key:
+        return
+    if PasswordFolderACL.objects.filter(folder_id=instance.folder_id, wrapped_key__isnull=False).exists():
+        instance.folder.share_datakey()
+
+
+# Keep the effective access of the ACL's user current, on the old target too when the ACL was moved
+@receiver(pre_save, sender=PasswordFolderACL)
+def remember_acl_target(sender, instance=None, raw=False, **kwargs):
+    if raw or instance.pk is None:
+        return
+    instance.previous_target = PasswordFolderACL.objects.filter(pk=instance.pk).values_list('user_id',
+                                                                                           'folder_id').first()
+
+
+@receiver(post_save, sender=PasswordFolderACL)
+def refresh_acl_access(sender, instance=None, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, 'previous_target', None)
+    if previous and previous != (instance.user_id, instance.folder_id):
+        if not defer_access_refresh(previous[1], previous[0]):
+            refresh_access(PasswordFolder.objects.get(pk=previous[1]), users=[previous[0]])
+    if not defer_access_refresh(instance.folder_id, instance.user_id):
+        refresh_access(instance.folder, users=[instance.user_id])
+
+
+# Refuse to delete the last wrapped copy of a data key its folder's secrets still need; raising here rolls the
+# delete back, callers that can re-wrap the key run PasswordFolder.keep_datakey first
+@receiver(post_delete, sender=PasswordFolderACL)
+def protect_datakey(sender, instance=None, **kwargs):
+    if not instance.wrapped_key:
+        return
+    folder = PasswordFolder.objects.filter(pk=instance.folder_id).first()
+    if folder is None or not folder.password_set.exists():
+        return
+    if not PasswordFolderACL.objects.filter(folder=folder, wrapped_key__isnull=False).exists():
+        raise ProtectedError('The last wrapped data key of folder {} cannot be deleted.'.format(folder.pk),
+                             [instance])
+
+
+@receiver(post_delete, sender=PasswordFolderACL)
+def revoke_acl_access(sender, instance=None, **kwargs):
+    if defer_access_refresh(instance.folder_id, instance.user_id):
+        return
+    folder = PasswordFolder.objects.filter(pk=instance.folder_id).first()
+    if folder is not None:
+        refresh_access(folder, users=[instance.user_id])
+
+
+# A folder created under or moved to another parent inherits the access of its new ancestors
+@receiver(pre_save, sender=PasswordFolder)
+def remember_folder_parent(sender, instance=None, raw=False, **kwargs):
+    if raw:
+        return
+    previous = PasswordFolder.objects.filter(pk=instance.pk).values_list('parent_id', flat=True).first() \
+        if instance.pk else None
+    instance.parent_changed = instance.parent_id != previous
+
+
+@receiver(post_save, sender=PasswordFolder)
+def refresh_folder_access(sender, instance=None, raw=False, **kwargs):
+    if raw or not getattr(instance, 'parent_changed', False):
+        return
+    refresh_access(instance)
@@ -1,19 +1,12 @@
 from rest_framework import permissions
 from core.models import AccessLevel
-from passwordfolders.models import PasswordFolderACL, PasswordFolder
+from passwordfolders.models import get_acl_folders, has_access, PasswordFolderACL, PasswordFolder
 
 
 # Password Folder Permissions
-def get_permission_level(request, obj):
-    if request.user == 'AnonymousUser':
-        level = None
-        return level
-    else:
-        try:
-            level = PasswordFolderACL.objects.get(folder=obj, user=request.user)
-        except:
-            level = None
-        return level
+def has_permission_level(request, obj, rank):
+    # effective access, inherited from parent folders included
+    return has_access(request.user, obj.pk, rank)
 
 
 # Password Folder Permissions
@@ -35,11 +28,7 @@ class CanCreatePasswordFolder(permissions.DjangoObjectPermissions):
                 if parent_name == '':
                     return True
                 else:
-                    parent_level = PasswordFolderACL.objects.get(folder__name=parent_name, user=request.user)
-                    if parent_level.level.name in ['Owner', 'Admin']:
-                        return True
-                    else:
-                        return False
+                    return get_acl_folders(request, AccessLevel.ADMIN).filter(name=parent_name).exists()
             return True
 
 
@@ -51,21 +40,9 @@ class CanRetrievePasswordFolder(permissions.DjangoObjectPermissions):
             return True
 
     def has_object_permission(self, request, view, obj):
-        access_levels = ['Owner', 'Admin', 'Read']
-        if get_permission_level(request, obj) is None:
-            if obj.personal:
-                if request.user == obj.user:
-                    return True
-                else:
-                    return False
-            else:
-                return False
-        else:
-            level = AccessLevel.objects.get(pk=get_permission_level(request, obj).level_id).name
-            if level in access_levels:
-                return True
-            else:
-                return False
+        if has_permission_level(request, obj, AccessLevel.READ):
+            return True
+        return obj.personal and request.user == obj.user
 
 
 class CanUpdatePasswordFolder(permissions.DjangoObjectPermissions):
@@ -76,17 +53,9 @@ class CanUpdatePasswordFolder(permissions.DjangoObjectPermissions):
             return True
 
     def has_object_permission(self, request, view, obj):
-        try:
-            level = get_permission_level(request, obj).level.name
-        except AttributeError:
-            if PasswordFolder.objects.get(pk=obj.id, user=request.user, personal=True):
-                level = 'Personal'
-            else:
-                return False
-        if level in ['Owner', 'Admin', 'Personal']:
+        if has_permission_level(request, obj, AccessLevel.ADMIN):
             return True
-        else:
-            return False
+        return PasswordFolder.objects.filter(pk=obj.id, user=request.user, personal=True).exists()
 
 
 class CanDestroyPasswordFolder(permissions.DjangoObjectPermissions):
@@ -97,17 +66,9 @@ class CanDestroyPasswordFolder(permissions.DjangoObjectPermissions):
             return True
 
     def has_object_permission(self, request, view, obj):
-        try:
-            level = get_permission_level(request, obj).level.name
-        except AttributeError:
-            if PasswordFolder.objects.get(pk=obj.id, user=request.user, personal=True):
-                level = 'Personal'
-            else:
-                return False
-        if level in ['Owner', 'Personal']:
+        if has_permission_level(request, obj, AccessLevel.OWNER):
             return True
-        else:
-            return False
+        return PasswordFolder.objects.filter(pk=obj.id, user=request.user, personal=True).exists()
 
 
 # Password Folder ACL Permissions
@@ -122,11 +83,7 @@ class CanCreatePasswordFolderACL(permissions.DjangoObjectPermissions):
                 if folder_type.personal is True:
                     return False
                 else:
-                    folder_level = PasswordFolderACL.objects.get(folder__pk=folder_id, user=request.user)
-                    if folder_level.level.name in ['Owner', 'Admin']:
-                        return True
-                    else:
-                        return False
+                    return has_access(request.user, folder_id, AccessLevel.ADMIN)
             return True
 
 
@@ -146,15 +103,7 @@ class CanRetrievePasswordFolderACL(permissions.DjangoObjectPermissions):
             return True
 
     def has_object_permission(self, request, view, obj):
-        try:
-            folder = PasswordFolderACL.objects.get(id=obj.id).folder
-            folder_level = PasswordFolderACL.objects.get(folder=folder, user=request.user)
-        except PasswordFolderACL.DoesNotExist:
-            return False
-        if folder_level.level.name in ['Owner', 'Admin']:
-            return True
-        else:
-            return False
+        return has_access(request.user, obj.folder_id, AccessLevel.ADMIN)
 
 
 class CanDestroyPasswordFolderACL(permissions.DjangoObjectPermissions):
@@ -174,10 +123,5 @@ class CanDestroyPasswordFolderACL(permissions.DjangoObjectPermissions):
                 return False
             else:
                 return True
-            level = get_permission_level(request, obj).level.name
         except AttributeError:
             return False
-        if level in ['Owner']:
-            return False
-        else:
-            return False
\ No newline at end of file
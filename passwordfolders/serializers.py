@@ -1,6 +1,17 @@
 from core.models import AccessLevel, User
-from passwordfolders.models import PasswordFolder, PasswordFolderACL
-from rest_framework.serializers import ModelSerializer, SlugRelatedField, HiddenField
+from core.registry import access_levels
+from core.serializers import SparseFieldsMixin
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from passwordfolders.models import (deferred_access_refresh,
+                                    get_acl_folders,
+                                    PasswordFolder,
+                                    PasswordFolderAccess,
+                                    PasswordFolderACL)
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.serializers import (HiddenField, IntegerField, ListField, ModelSerializer, Serializer,
+                                        SlugRelatedField, ValidationError)
 from rest_framework.validators import UniqueTogetherValidator
 from taggit_serializer.serializers import TagListSerializerField, TaggitSerializer
 
@@ -14,31 +25,26 @@ class PasswordFolderACLSerializer(ModelSerializer):
         validators = [
             UniqueTogetherValidator(
                 queryset=PasswordFolderACL.objects.all(),
-                fields=('user', 'folder', 'level')
+                fields=('user', 'folder')
             )
         ]
 
     def __init__(self, *args, **kwargs):
-        user = kwargs['context']['request'].user
+        request = kwargs['context']['request']
 
         super(PasswordFolderACLSerializer, self).__init__(*args, **kwargs)
         try:
-            placl = PasswordFolderACL.objects.select_related('folder').filter(user_id=user,
-                                                                              level__name__in=['Owner', 'Admin'])
-            folder_list = []
-            for p in placl:
-                folder_list.append(p.folder_id)
-            self.fields['folder'].queryset = PasswordFolder.objects.filter(id__in=folder_list)
+            self.fields['folder'].queryset = get_acl_folders(request, AccessLevel.ADMIN)
         except (PasswordFolderACL.DoesNotExist, TypeError):
             self.fields['folder'].queryset = None
 
 
-class PasswordFolderSerializer(TaggitSerializer, ModelSerializer):
+class PasswordFolderSerializer(SparseFieldsMixin, TaggitSerializer, ModelSerializer):
     tags = TagListSerializerField()
 
     def create(self, validated_data):
         request = self.context.get('request')
-        owner = AccessLevel.objects.get(id=1)
+        owner = access_levels.get(pk=1)
         if validated_data['personal']:
             validated_data['user'] = request.user
         passwordfolder = PasswordFolder.objects.create(**validated_data)
@@ -59,14 +65,100 @@ class PasswordFolderSerializer(TaggitSerializer, ModelSerializer):
         ]
 
     def __init__(self, *args, **kwargs):
-        user = kwargs['context']['request'].user
+        request = kwargs['context']['request']
 
         super(PasswordFolderSerializer, self).__init__(*args, **kwargs)
+        if 'parent' not in self.fields:
+            return
         try:
-            placl = PasswordFolderACL.objects.select_related('folder').filter(user_id=user)
-            folder_list = []
-            for p in placl:
-                folder_list.append(p.folder_id)
-            self.fields['parent'].queryset = PasswordFolder.objects.filter(id__in=folder_list)
+            self.fields['parent'].queryset = get_acl_folders(request)
         except (PasswordFolderACL.DoesNotExist, TypeError):
             self.fields['parent'].queryset = None
+
+
+class PasswordFolderACLBulkSerializer(Serializer):
+    """
+    Grant `level` on every folder of `folders` to every user of `users`, or revoke it, in one transaction.
+
+    The caller's rights on all folders are read with one query, the requested pairs are diffed against the
+    existing ACLs, and the changes are written with one bulk_create, one update and one delete.
+    """
+    users = ListField(child=IntegerField(), allow_empty=False)
+    folders = ListField(child=IntegerField(), allow_empty=False)
+    level = IntegerField(required=False)
+
+    def validate_users(self, value):
+        users = set(value)
+        if self.context['request'].user.pk in users:
+            raise ValidationError('Your own access cannot be changed in bulk.')
+        missing = users - set(User.objects.filter(pk__in=users).values_list('pk', flat=True))
+        if missing:
+            raise ValidationError('Invalid pks {} - objects do not exist.'.format(sorted(missing)))
+        return sorted(users)
+
+    def validate_level(self, value):
+        try:
+            return access_levels.get(pk=value)
+        except AccessLevel.DoesNotExist:
+            raise ValidationError('Invalid pk "{}" - object does not exist.'.format(value))
+
+    def check_rights(self, rank):
+        """
+        Return {folder id: caller's rank} for the requested folders, which must be shared folders the caller holds
+        Admin or more on, and at least `rank`. Raises PermissionDenied listing the others.
+        """
+        folders = set(self.validated_data['folders'])
+        rights = dict(PasswordFolderAccess.objects.filter(user=self.context['request'].user, folder_id__in=folders,
+                                                          folder__personal=False,
+                                                          level__rank__gte=max(rank, AccessLevel.ADMIN))
+                      .values_list('folder_id', 'level__rank'))
+        if folders - set(rights):
+            raise PermissionDenied({'folders': sorted(folders - set(rights))})
+        return rights
+
+    def grant(self):
+        level = self.validated_data.get('level')
+        if level is None:
+            raise ValidationError({'level': ['This field is required.']})
+        users = self.validated_data['users']
+        rights = self.check_rights(level.rank)
+        existing = {(acl['user_id'], acl['folder_id']): acl for acl in PasswordFolderACL.objects
+                    .filter(user_id__in=users, folder_id__in=rights).values('pk', 'user_id', 'folder_id', 'level_id')}
+        new = [PasswordFolderACL(user_id=user, folder_id=folder, level=level)
+               for folder in sorted(rights) for user in users if (user, folder) not in existing]
+        # ACLs above the caller's own level are left as they are
+        changed = [acl for acl in existing.values() if acl['level_id'] != level.pk and
+                   access_levels.get(pk=acl['level_id']).rank <= rights[acl['folder_id']]]
+        with transaction.atomic(), deferred_access_refresh() as pending:
+            # bulk_create and update skip the ACL signals and auto_now: wrap the data key for new holders and refresh
+            # access here
+            PasswordFolderACL.objects.bulk_create(new)
+            PasswordFolderACL.objects.filter(pk__in=[acl['pk'] for acl in changed]).update(level=level, modified=timezone.now())
+            for acl in new:
+                pending[acl.folder_id].add(acl.user_id)
+            for acl in changed:
+                pending[acl['folder_id']].add(acl['user_id'])
+            keyed = PasswordFolderACL.objects.filter(folder_id__in={acl.folder_id for acl in new},
+                                                     wrapped_key__isnull=False).values('folder_id')
+            for folder in PasswordFolder.objects.filter(pk__in=keyed):
+                folder.share_datakey()
+        return {'created': len(new), 'updated': len(changed), 'deleted': 0}
+
+    def revoke(self):
+        level = self.validated_data.get('level')
+        rights = self.check_rights(level.rank if level else 0)
+        # ACLs above the caller's own level are left as they are
+        scope = Q(pk__in=[])
+        for rank in set(rights.values()):
+            scope |= Q(folder_id__in=[folder for folder, right in rights.items() if right == rank],
+                       level__rank__lte=rank)
+        acls = PasswordFolderACL.objects.filter(scope, user_id__in=self.validated_data['users'])
+        if level is not None:
+            acls = acls.filter(level=level)
+        with transaction.atomic(), deferred_access_refresh():
+            # a caller whose rights come from a parent may revoke every direct ACL of a folder: the data key is
+            # re-wrapped for them first so its secrets stay readable
+            for folder in PasswordFolder.objects.filter(pk__in=acls.values('folder_id')):
+                folder.keep_datakey(acls, self.context['request'].user)
+            deleted = acls.delete()[1].get(PasswordFolderACL._meta.label, 0)
+        return {'created': 0, 'updated': 0, 'deleted': deleted}
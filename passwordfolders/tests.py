@@ -1,8 +1,17 @@
+from datetime import timedelta
+from io import StringIO
+from django.core.management import call_command
+from django.core.management.sql import emit_post_migrate_signal
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import force_authenticate, APITestCase, APIClient, APIRequestFactory
 from core.models import User, Owner, AccessLevel
-from passwordfolders.models import PasswordFolder, PasswordFolderACL
+from passwordfolders.models import has_access, PasswordFolder, PasswordFolderAccess, PasswordFolderACL
+from passwordfolders.serializers import PasswordFolderACLSerializer
 from passwordfolders.views import PasswordFolderViewSet, PasswordFolderACLViewSet
 
 
@@ -29,6 +38,24 @@ class PasswordFolderAPITestCase(APITestCase):
         response = view(request)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    # ?fields= and ?exclude= can leave out the parent field on list and retrieve
+    def test_passwordfolder_sparse_fields(self):
+        user = User.objects.get(username='regular')
+        url = reverse('passwordfolder:passwordfolder-list')
+        for params in ({'fields': 'id,name'}, {'exclude': 'parent'}):
+            request = APIRequestFactory().get(url, params)
+            force_authenticate(request, user=user)
+            response = PasswordFolderViewSet.as_view({'get': 'list'})(request)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.data['results'])
+            self.assertTrue(all('parent' not in folder for folder in response.data['results']))
+        request = APIRequestFactory().get(reverse('passwordfolder:passwordfolder-detail', args=(2,)),
+                                          {'fields': 'id,name'})
+        force_authenticate(request, user=user)
+        response = PasswordFolderViewSet.as_view({'get': 'retrieve'})(request, pk=2)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data), {'id', 'name'})
+
     # Retrieve Password Folder as Test User
     def test_passwordfolder_detail(self):
         factory = APIRequestFactory()
@@ -146,9 +173,6 @@ class PasswordFolderACLAPITestCase(APITestCase):
     # Patch Password Folder ACL as Test User
     def test_passwordfolderacl_put(self):
         user = User.objects.get(username='regular')
-        folder = PasswordFolder.objects.get(name='Shared')
-        level = AccessLevel.objects.get(name='Admin')
-        PasswordFolderACL.objects.create(user=user, folder=folder, level=level)
         factory = APIRequestFactory()
         view = PasswordFolderACLViewSet.as_view({'post': 'update'})
         url = reverse('passwordfolder:passwordfolderacl-detail', args=(PasswordFolderACL.pk,))
@@ -171,4 +195,176 @@ class PasswordFolderACLAPITestCase(APITestCase):
         request = factory.post(url)
         force_authenticate(request, user=user)
         response = view(request, pk=2)
-        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+    # Data keys wrapped with outdated KDF parameters are re-wrapped when read
+    def test_passwordfolderacl_kdf_upgrade_on_read(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        datakey = folder.get_datakey(user)
+        self.assertEqual(PasswordFolderACL.objects.get(user=user, folder=folder).kdf, 'pbkdf2-sha256$iterations=100000')
+        with override_settings(KDF='scrypt$n=1024,r=8,p=1'):
+            self.assertEqual(folder.get_datakey(user), datakey)
+            acl = PasswordFolderACL.objects.get(user=user, folder=folder)
+            self.assertEqual(acl.kdf, 'scrypt$n=1024,p=1,r=8')
+            self.assertEqual(folder.get_datakey(user), datakey)
+
+    # Writable folder querysets are lazy subqueries shared across the serializers of a request
+    def test_passwordfolderacl_lazy_folder_queryset(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        other = PasswordFolder.objects.create(name='Other', description='Other Folder', parent=None)
+        request = APIRequestFactory().get(reverse('passwordfolder:passwordfolderacl-list'))
+        request.user = user
+        with self.assertNumQueries(0):
+            first = PasswordFolderACLSerializer(context={'request': request})
+            second = PasswordFolderACLSerializer(context={'request': request})
+        self.assertIs(first.fields['folder'].queryset, second.fields['folder'].queryset)
+        self.assertIn(folder, first.fields['folder'].queryset)
+        self.assertNotIn(other, second.fields['folder'].queryset)
+
+    # Tags are prefetched, so listing more folders does not add queries
+    def test_passwordfolder_list_query_count(self):
+        user = User.objects.get(username='regular')
+        view = PasswordFolderViewSet.as_view({'get': 'list'})
+        sizes = []
+        counts = []
+        for added in (1, 4):
+            for i in range(added):
+                folder = PasswordFolder.objects.create(name='Folder {}'.format(PasswordFolder.objects.count()),
+                                                       description='Folder', parent=None)
+                PasswordFolderACL.objects.create(user=user, folder=folder, level=AccessLevel.objects.get(name='Read'))
+                folder.tags.add('shared')
+            request = APIRequestFactory().get(reverse('passwordfolder:passwordfolder-list'))
+            force_authenticate(request, user=user)
+            with CaptureQueriesContext(connection) as queries:
+                response = view(request)
+            sizes.append(len(response.data['results']))
+            counts.append(len(queries))
+        self.assertEqual(sizes[1] - sizes[0], 4)
+        self.assertEqual(counts[0], counts[1])
+
+    # A user holds at most one ACL per folder
+    def test_passwordfolderacl_unique_user_folder(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        view = PasswordFolderACLViewSet.as_view({'post': 'create'})
+        request = APIRequestFactory().post(reverse('passwordfolder:passwordfolderacl-list'),
+                                           {'user': user.pk, 'folder': folder.pk, 'level': 2})
+        force_authenticate(request, user=user)
+        response = view(request)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(PasswordFolderACL.objects.filter(user=user, folder=folder).count(), 1)
+
+    # ACLs flow down the folder tree through the effective access table
+    def test_passwordfolder_access_inheritance(self):
+        user = User.objects.get(username='regular')
+        second = User.objects.get(username='second')
+        parent = PasswordFolder.objects.get(name='Shared')
+        child = PasswordFolder.objects.create(name='Child', description='Child Folder', parent=parent)
+        grandchild = PasswordFolder.objects.create(name='Grandchild', description='Grandchild Folder', parent=child)
+        PasswordFolderACL.objects.create(user=user, folder=grandchild, level=AccessLevel.objects.get(name='Owner'))
+        PasswordFolderACL.objects.create(user=second, folder=parent, level=AccessLevel.objects.get(name='Read'))
+        PasswordFolderACL.objects.create(user=second, folder=child, level=AccessLevel.objects.get(name='Admin'))
+        access = dict(PasswordFolderAccess.objects.filter(user=second, folder__in=[parent, child, grandchild])
+                      .values_list('folder__name', 'level__name'))
+        self.assertEqual(access, {'Shared': 'Read', 'Child': 'Admin', 'Grandchild': 'Admin'})
+        self.assertEqual(grandchild.get_datakey(second), grandchild.get_datakey(user))
+
+        grandchild.move_to(parent)
+        grandchild.save()
+        self.assertEqual(PasswordFolderAccess.objects.get(user=second, folder=grandchild).level.name, 'Read')
+        PasswordFolderACL.objects.filter(user=second, folder=parent).get().delete()
+        self.assertFalse(PasswordFolderAccess.objects.filter(user=second, folder=grandchild).exists())
+        with self.assertRaises(PasswordFolderACL.DoesNotExist):
+            grandchild.get_datakey(second)
+
+        expected = set(PasswordFolderAccess.objects.values_list('user_id', 'folder_id', 'level_id'))
+        PasswordFolderAccess.objects.all().delete()
+        call_command('rebuild_folder_access', stdout=StringIO())
+        self.assertEqual(set(PasswordFolderAccess.objects.values_list('user_id', 'folder_id', 'level_id')), expected)
+
+    # Grant and revoke ACLs for many users and folders at once
+    def test_passwordfolderacl_bulk_grant_revoke(self):
+        user = User.objects.get(username='regular')
+        second = User.objects.get(username='second')
+        third = User.objects.create_user(username='third', password='Welcome2', email='third@user.com')
+        shared = PasswordFolder.objects.get(name='Shared')
+        child = PasswordFolder.objects.create(name='Child', description='Child Folder', parent=shared)
+        other = PasswordFolder.objects.create(name='Other', description='Other Folder', parent=None)
+        PasswordFolderACL.objects.create(user=user, folder=other, level=AccessLevel.objects.get(name='Owner'))
+        datakey = shared.get_datakey(user)
+        read = AccessLevel.objects.get(name='Read')
+        modify = AccessLevel.objects.get(name='Modify')
+        grant = PasswordFolderACLViewSet.as_view({'post': 'grant'})
+        revoke = PasswordFolderACLViewSet.as_view({'post': 'revoke'})
+
+        def post(view, url, data):
+            request = APIRequestFactory().post(reverse(url), data, format='json')
+            force_authenticate(request, user=user)
+            return view(request)
+
+        data = {'users': [second.pk, third.pk], 'folders': [shared.pk, other.pk], 'level': read.pk}
+        response = post(grant, 'passwordfolder:passwordfolderacl-grant', data)
+        self.assertEqual(response.data, {'created': 4, 'updated': 0, 'deleted': 0})
+        self.assertEqual(PasswordFolderAccess.objects.get(user=third, folder=child).level, read)
+        self.assertEqual(shared.get_datakey(second), datakey)
+
+        response = post(grant, 'passwordfolder:passwordfolderacl-grant', dict(data, level=modify.pk))
+        self.assertEqual(response.data, {'created': 0, 'updated': 4, 'deleted': 0})
+        self.assertEqual(PasswordFolderAccess.objects.get(user=third, folder=child).level, modify)
+
+        personal = PasswordFolder.objects.get(name='Personal', user=user)
+        response = post(grant, 'passwordfolder:passwordfolderacl-grant', dict(data, folders=[personal.pk]))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = post(grant, 'passwordfolder:passwordfolderacl-grant', dict(data, users=[user.pk]))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = post(revoke, 'passwordfolder:passwordfolderacl-revoke', {'users': data['users'],
+                                                                             'folders': data['folders']})
+        self.assertEqual(response.data, {'created': 0, 'updated': 0, 'deleted': 4})
+        self.assertFalse(PasswordFolderAccess.objects.filter(user__in=[second, third],
+                                                             folder__in=[shared, child, other]).exists())
+
+    # A bulk level change bumps the ACLs' modified, so list ETags of the grantee change
+    def test_passwordfolderacl_bulk_grant_etag(self):
+        user = User.objects.get(username='regular')
+        second = User.objects.get(username='second')
+        shared = PasswordFolder.objects.get(name='Shared')
+        PasswordFolderACL.objects.create(user=second, folder=shared, level=AccessLevel.objects.get(name='Read'))
+        PasswordFolderACL.objects.filter(user=second).update(modified=timezone.now() - timedelta(minutes=1))
+        folders = PasswordFolderViewSet.as_view({'get': 'list'})
+        request = APIRequestFactory().get(reverse('passwordfolder:passwordfolder-list'))
+        force_authenticate(request, user=second)
+        etag = folders(request)['ETag']
+
+        request = APIRequestFactory().post(reverse('passwordfolder:passwordfolderacl-grant'), {
+            'users': [second.pk], 'folders': [shared.pk], 'level': AccessLevel.objects.get(name='Modify').pk},
+            format='json')
+        force_authenticate(request, user=user)
+        self.assertEqual(PasswordFolderACLViewSet.as_view({'post': 'grant'})(request).data['updated'], 1)
+
+        request = APIRequestFactory().get(reverse('passwordfolder:passwordfolder-list'), HTTP_IF_NONE_MATCH=etag)
+        force_authenticate(request, user=second)
+        response = folders(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    # Permission checks compare level ranks in the database: at least Admin is one query
+    def test_passwordfolder_access_rank(self):
+        user = User.objects.get(username='regular')
+        second = User.objects.get(username='second')
+        folder = PasswordFolder.objects.get(name='Shared')
+        PasswordFolderACL.objects.create(user=second, folder=folder, level=AccessLevel.objects.get(name='Modify'))
+        with self.assertNumQueries(1):
+            self.assertTrue(has_access(user, folder.pk, AccessLevel.ADMIN))
+        self.assertTrue(has_access(second, folder.pk, AccessLevel.READ))
+        self.assertTrue(has_access(second, folder.pk, AccessLevel.MODIFY))
+        self.assertFalse(has_access(second, folder.pk, AccessLevel.ADMIN))
+
+    # Stock levels without a rank are ranked after migrate
+    def test_accesslevel_rank_backfill(self):
+        AccessLevel.objects.update(rank=0)
+        emit_post_migrate_signal(verbosity=0, interactive=False, db='default')
+        self.assertEqual(dict(AccessLevel.objects.values_list('name', 'rank')),
+                         {'Owner': 40, 'Admin': 30, 'Modify': 20, 'Read': 10})
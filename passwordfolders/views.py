@@ -1,12 +1,17 @@
 import json
 from django.http import Http404
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import ProtectedError, Q
 from rest_framework import status, viewsets
+from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 
+from core.conditional import list_etag, not_modified, set_validators
 from core.models import AccessLevel
-from passwordfolders.models import PasswordFolder, PasswordFolderACL
+from core.pagination import ModifiedCursorPagination
+from core.serializers import sparse_fields
+from passwordfolders.models import PasswordFolder, PasswordFolderAccess, PasswordFolderACL
 from passwordfolders.permissions import (CanCreatePasswordFolder,
                                          CanListPasswordFolder,
                                          CanRetrievePasswordFolder,
@@ -17,13 +22,16 @@ from passwordfolders.permissions import (CanCreatePasswordFolder,
                                          CanRetrievePasswordFolderACL,
                                          CanDestroyPasswordFolderACL,
                                          )
-from passwordfolders.serializers import PasswordFolderSerializer, PasswordFolderACLSerializer
+from passwordfolders.serializers import (PasswordFolderSerializer,
+                                         PasswordFolderACLSerializer,
+                                         PasswordFolderACLBulkSerializer)
 
 
 # Password Folder View
 class PasswordFolderViewSet(viewsets.ModelViewSet):
     queryset = PasswordFolder.objects.all()
     serializer_class = PasswordFolderSerializer
+    pagination_class = ModifiedCursorPagination
     permission_classes_by_action = {'create': [CanCreatePasswordFolder, IsAuthenticated],
                                     'list': [CanListPasswordFolder, IsAuthenticated],
                                     'retrieve': [CanRetrievePasswordFolder, IsAuthenticated],
@@ -31,14 +39,22 @@ class PasswordFolderViewSet(viewsets.ModelViewSet):
                                     'destroy': [CanDestroyPasswordFolder, IsAuthenticated]}
 
     def list(self, request, **kwargs):
-        access_levels = AccessLevel.objects.filter(name__in=['Owner', 'Admin', 'Modify', 'Read'])
         try:
-            queryset = self.get_queryset().filter(Q(
-                passwordfolderacl__user=request.user,
-                passwordfolderacl__level__in=access_levels) | Q(personal=True, user=request.user)
-            )
-            serializer = PasswordFolderSerializer(queryset, many=True, context={'request': request})
-            return Response(serializer.data)
+            access = PasswordFolderAccess.objects.filter(user=request.user, level__rank__gte=AccessLevel.READ)
+            queryset = self.get_queryset().filter(Q(id__in=access.values('folder_id')) |
+                                                  Q(personal=True, user=request.user))
+            etag = list_etag(request, queryset)
+            response = not_modified(request, etag)
+            if response is not None:
+                return response
+            fields = sparse_fields(request, PasswordFolderSerializer.Meta.fields)
+            # parent is read by mptt when instances are built
+            queryset = queryset.only(*({'id', 'modified', 'parent'} | set(fields) - {'tags'}))
+            if 'tags' in fields:
+                queryset = queryset.prefetch_related('tags')
+            serializer = PasswordFolderSerializer(self.paginate_queryset(queryset), many=True,
+                                                  context={'request': request})
+            return set_validators(self.get_paginated_response(serializer.data), etag)
         except TypeError:
             return Response(status=status.HTTP_401_UNAUTHORIZED)
 
@@ -75,12 +91,15 @@ class PasswordFolderViewSet(viewsets.ModelViewSet):
             instance = self.get_object()
             acl_instances = PasswordFolderACL.objects.filter(folder=pk)
             self.check_object_permissions(self.request, instance)
-            # destroy all associated ACL objects
-            for i in acl_instances:
-                self.perform_destroy(i)
-            self.perform_destroy(instance)
+            # destroy all associated ACL objects; a folder that still holds passwords keeps them and its data key
+            with transaction.atomic():
+                for i in acl_instances:
+                    self.perform_destroy(i)
+                self.perform_destroy(instance)
         except Http404:
             pass
+        except ProtectedError:
+            return Response({'detail': 'The folder still holds passwords.'}, status=status.HTTP_409_CONFLICT)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def get_permissions(self):
@@ -98,21 +117,23 @@ class PasswordFolderACLViewSet(viewsets.ModelViewSet):
     http_method_names = ['get', 'post', 'delete']
     queryset = PasswordFolderACL.objects.all()
     serializer_class = PasswordFolderACLSerializer
+    pagination_class = ModifiedCursorPagination
     permission_classes_by_action = {'create': [CanCreatePasswordFolderACL],
                                     'list': [CanListPasswordFolderACL],
                                     'retrieve': [CanRetrievePasswordFolderACL],
-                                    'destroy': [CanDestroyPasswordFolderACL]}
+                                    'destroy': [CanDestroyPasswordFolderACL],
+                                    'grant': [CanListPasswordFolderACL, IsAuthenticated],
+                                    'revoke': [CanListPasswordFolderACL, IsAuthenticated]}
 
     def list(self, request, **kwargs):
         try:
-            folders = PasswordFolder.objects.filter(passwordfolderacl__in=self.get_queryset().filter(
-                user=request.user, level__name__in=['Owner', 'Admin'])
-            )
-            queryset = self.get_queryset().filter(folder__in=folders)
+            folders = PasswordFolderAccess.objects.filter(user=request.user, level__rank__gte=AccessLevel.ADMIN)
+            queryset = self.get_queryset().filter(folder__in=folders.values('folder_id'))
         except TypeError:
-            queryset = None
-        serializer = PasswordFolderACLSerializer(queryset, many=True, context={'request': request})
-        return Response(serializer.data, status=status.HTTP_200_OK)
+            queryset = PasswordFolderACL.objects.none()
+        serializer = PasswordFolderACLSerializer(self.paginate_queryset(queryset), many=True,
+                                                 context={'request': request})
+        return self.get_paginated_response(serializer.data)
 
     def create(self, request, **kwargs):
         try:
@@ -124,6 +145,22 @@ class PasswordFolderACLViewSet(viewsets.ModelViewSet):
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    # {"users": [...], "folders": [...], "level": id}: every user gets `level` on every folder
+    @action(detail=False, methods=['post'])
+    def grant(self, request):
+        serializer = PasswordFolderACLBulkSerializer(data=request.data, context={'request': request})
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response(serializer.grant(), status=status.HTTP_200_OK)
+
+    # {"users": [...], "folders": [...]}, optionally "level" to revoke only ACLs of that level
+    @action(detail=False, methods=['post'])
+    def revoke(self, request):
+        serializer = PasswordFolderACLBulkSerializer(data=request.data, context={'request': request})
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        return Response(serializer.revoke(), status=status.HTTP_200_OK)
+
     def retrieve(self, request, pk=None, **kwargs):
         try:
             instance = self.get_object()
@@ -149,9 +186,14 @@ class PasswordFolderACLViewSet(viewsets.ModelViewSet):
         try:
             instance = self.get_object()
             self.check_object_permissions(self.request, instance)
-            self.perform_destroy(instance)
+            with transaction.atomic():
+                instance.folder.keep_datakey(PasswordFolderACL.objects.filter(pk=instance.pk), request.user)
+                self.perform_destroy(instance)
         except PasswordFolderACL.DoesNotExist:
             return Response(status=status.HTTP_404_NOT_FOUND)
+        except ProtectedError:
+            return Response({'detail': 'The last wrapped data key of the folder cannot be deleted.'},
+                            status=status.HTTP_409_CONFLICT)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def get_permissions(self):
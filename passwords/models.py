@@ -1,6 +1,7 @@
 from django.db import models
+from django.db.models import Exists, OuterRef, Q
 from core.models import Owner, User
-from passwordfolders.models import PasswordFolder
+from passwordfolders.models import PasswordFolder, PasswordFolderAccess
 from taggit.managers import TaggableManager
 from uuid import uuid4
 
@@ -17,25 +18,70 @@ class PasswordType(models.Model):
         return self.name
 
 
+class PasswordQuerySet(models.QuerySet):
+
+    def visible_to(self, user):
+        """
+        Passwords `user` can see through access to their folder, their personal folder or a password ACL, each once.
+        """
+        return self.annotate(
+            folder_access=Exists(PasswordFolderAccess.objects.filter(folder=OuterRef('folder'), user=user).values('pk')),
+            password_acl=Exists(PasswordACL.objects.filter(password=OuterRef('pk'), user=user).values('pk')),
+        ).filter(Q(folder_access=True) | Q(password_acl=True) | Q(folder__user=user, folder__personal=True))
+
+
 class Password(models.Model):
+    SCHEME_PLAINTEXT = 0
+    SCHEME_LEGACY = 1  # master key, then the creator's personal key
+    SCHEME_FOLDERKEY = 2  # folder data key
+    SCHEME_AEAD = 3  # AES-GCM with the master and folder data keys combined, stored in `secret`
+    SCHEME_CHOICES = (
+        (SCHEME_PLAINTEXT, 'Plaintext'),
+        (SCHEME_LEGACY, 'Master and personal key'),
+        (SCHEME_FOLDERKEY, 'Folder data key'),
+        (SCHEME_AEAD, 'Master and folder data key AEAD'),
+    )
+
     name = models.CharField(max_length=100)
     description = models.CharField(max_length=1024)
     type = models.ForeignKey(PasswordType, null=True, on_delete=models.PROTECT)
     username = models.CharField(max_length=50)
-    password = models.CharField(max_length=1024)
+    password = models.CharField(max_length=1024, blank=True)
+    secret = models.BinaryField(null=True, default=None)
+    # null until backfilled by backfill_password_scheme
+    scheme = models.PositiveSmallIntegerField(choices=SCHEME_CHOICES, null=True, default=None)
+    key_id = models.CharField(max_length=16, blank=True, default='')
     url = models.CharField(max_length=1024, null=True)
     folder = models.ForeignKey(PasswordFolder, on_delete=models.PROTECT)
     tags = TaggableManager(blank=True)
     created = models.DateTimeField(auto_now_add=True, blank=False)
     modified = models.DateTimeField(auto_now=True, blank=True)
 
+    objects = PasswordQuerySet.as_manager()
+
     class Meta:
         db_table = 'enterpass_password'
         managed = True
+        # cursor pagination order; passwords of a folder by name
+        indexes = [models.Index(fields=['modified', 'id'], name='password_modified_id'),
+                   models.Index(fields=['folder', 'name'], name='password_folder_name')]
 
     def __str__(self):
         return self.name
 
+    def get_scheme(self):
+        """
+        Return the encryption scheme of `password`; None for rows written before the scheme column whose
+        ciphertext has not been classified yet.
+        """
+        if self.scheme is not None:
+            return self.scheme
+        if self.secret:
+            return self.SCHEME_AEAD
+        if 'gAAA' not in self.password:
+            return self.SCHEME_PLAINTEXT
+        return None
+
 
 class PasswordACL(models.Model):
     user = models.ForeignKey(User, on_delete=models.PROTECT)
@@ -47,3 +93,6 @@ class PasswordACL(models.Model):
     class Meta:
         db_table = 'enterpass_passwordacl'
         managed = True
+        unique_together = (('user', 'password'),)
+        # cursor pagination order
+        indexes = [models.Index(fields=['modified', 'id'], name='passwordacl_modified_id')]
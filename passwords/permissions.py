@@ -1,26 +1,19 @@
 from django.db.models import Q
 from rest_framework import permissions
-from core.models import AccessLevel
 from core.permissions import is_application, is_servicedesk, is_superuser, is_support
-from passwords.models import Password, PasswordACL
-from passwordfolders.models import PasswordFolderACL, PasswordFolder
+from core.models import AccessLevel
+from passwords.models import Password
+from passwordfolders.models import has_access, PasswordFolder
 
 
 # Password Permission per Object based on folder ACL
-def get_permission_level(request, obj):
-    if request.user == 'AnonymousUser':
-        level = None
-        return level
-    else:
-        try:
-            level = PasswordFolderACL.objects.get(folder=obj.folder, user=request.user)
-        except AttributeError:
-            acl = PasswordACL.objects.get(pk=obj.id)
-            password = Password.objects.get(pk=acl.password.pk)
-            level = PasswordFolderACL.objects.get(folder=password.folder, user=request.user)
-        except:
-            level = None
-        return level
+def has_permission_level(request, obj, rank):
+    # effective access on the folder, inherited from parent folders included
+    try:
+        folder_id = obj.folder_id
+    except AttributeError:
+        folder_id = obj.password.folder_id
+    return has_access(request.user, folder_id, rank)
 
 
 # Password Permissions
@@ -42,11 +35,7 @@ class CanCreatePassword(permissions.DjangoObjectPermissions):
                 if folder_id == '':
                     return True
                 else:
-                    folder_level = PasswordFolderACL.objects.get(folder__id=folder_id, user=request.user)
-                    if folder_level.level.name in ['Owner', 'Admin']:
-                        return True
-                    else:
-                        return False
+                    return has_access(request.user, folder_id, AccessLevel.ADMIN)
             return True
 
 
@@ -58,15 +47,7 @@ class CanRetrievePassword(permissions.DjangoObjectPermissions):
             return True
 
     def has_object_permission(self, request, view, obj):
-        access_levels = ['Owner', 'Admin', 'Modify', 'Read']
-        if get_permission_level(request, obj) is None:
-            return False
-        else:
-            level = AccessLevel.objects.get(pk=get_permission_level(request, obj).level_id).name
-            if level in access_levels:
-                return True
-            else:
-                return False
+        return Password.objects.visible_to(request.user).filter(pk=obj.pk).exists()
 
 
 class CanUpdatePassword(permissions.DjangoObjectPermissions):
@@ -78,15 +59,7 @@ class CanUpdatePassword(permissions.DjangoObjectPermissions):
             return True
 
     def has_object_permission(self, request, view, obj):
-        access_levels = ['Owner', 'Admin', 'Modify']
-        if get_permission_level(request, obj) is None:
-            return False
-        else:
-            level = AccessLevel.objects.get(pk=get_permission_level(request, obj).level_id).name
-            if level in access_levels:
-                return True
-            else:
-                return False
+        return has_permission_level(request, obj, AccessLevel.MODIFY)
 
 
 class CanDestroyPassword(permissions.DjangoObjectPermissions):
@@ -98,15 +71,7 @@ class CanDestroyPassword(permissions.DjangoObjectPermissions):
             return True
 
     def has_object_permission(self, request, view, obj):
-        access_levels = ['Owner', 'Admin']
-        if get_permission_level(request, obj) is None:
-            return False
-        else:
-            level = AccessLevel.objects.get(pk=get_permission_level(request, obj).level_id).name
-            if level in access_levels:
-                return True
-            else:
-                return False
+        return has_permission_level(request, obj, AccessLevel.ADMIN)
 
 
 # Password ACL Permissions
@@ -127,11 +92,7 @@ class CanCreatePasswordACL(permissions.DjangoObjectPermissions):
         else:
             password = request.data['password']
             folder = PasswordFolder.objects.get(pk=password)
-            folder_level = PasswordFolderACL.objects.get(folder=folder, user=request.user)
-            if folder_level.level.name in ['Owner', 'Admin']:
-                return True
-            else:
-                return False
+            return has_access(request.user, folder.pk, AccessLevel.ADMIN)
 
 
 class CanRetrievePasswordACL(permissions.DjangoObjectPermissions):
@@ -142,17 +103,9 @@ class CanRetrievePasswordACL(permissions.DjangoObjectPermissions):
         else:
             return True
 
+    # same scope as the list: the ACL's own user, or Admins of the password's folder
     def has_object_permission(self, request, view, obj):
-        access_levels = ['Owner', 'Admin', 'Modify', 'Read']
-        if get_permission_level(request, obj) is None:
-            return False
-        else:
-            level = AccessLevel.objects.get(pk=get_permission_level(request, obj).level_id).name
-            print('test')
-            if level in access_levels:
-                return True
-            else:
-                return False
+        return obj.user_id == request.user.pk or has_permission_level(request, obj, AccessLevel.ADMIN)
 
 
 class CanUpdatePasswordACL(permissions.DjangoObjectPermissions):
@@ -163,15 +116,7 @@ class CanUpdatePasswordACL(permissions.DjangoObjectPermissions):
             return True
 
     def has_object_permission(self, request, view, obj):
-        access_levels = ['Owner', 'Admin', 'Modify']
-        if get_permission_level(request, obj) is None:
-            return False
-        else:
-            level = AccessLevel.objects.get(pk=get_permission_level(request, obj).level_id).name
-            if level in access_levels:
-                return True
-            else:
-                return False
+        return has_permission_level(request, obj, AccessLevel.MODIFY)
 
 
 class CanDestroyPasswordACL(permissions.DjangoObjectPermissions):
@@ -182,13 +127,4 @@ class CanDestroyPasswordACL(permissions.DjangoObjectPermissions):
             return True
 
     def has_object_permission(self, request, view, obj):
-        access_levels = ['Owner', 'Admin']
-        if get_permission_level(request, obj) is None:
-            return False
-        else:
-            level = AccessLevel.objects.get(pk=get_permission_level(request, obj).level_id).name
-            print(level)
-            if level in access_levels:
-                return True
-            else:
-                return False
+        return has_permission_level(request, obj, AccessLevel.ADMIN)
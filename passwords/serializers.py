@@ -1,11 +1,25 @@
-from core.models import User
+from core.models import AccessLevel
 from passwords.models import Password, PasswordACL, PasswordType
-from passwordfolders.models import PasswordFolder, PasswordFolderACL
-from core.scripts.encryption import (decrypt_password,
-                                     encrypt_password,
-                                     generate_masterkey,
-                                     generate_personalkey)
-from rest_framework.serializers import ModelSerializer, SlugRelatedField, UUIDField
+from passwordfolders.models import get_acl_folders, PasswordFolder, PasswordFolderAccess, PasswordFolderACL
+from core.registry import password_types
+from core.scripts.bulk import bulk_update
+from core.scripts.encryption import (decrypt_aead,
+                                     decrypt_password,
+                                     decrypt_secret,
+                                     decrypt_secrets,
+                                     encrypt_aead,
+                                     get_key_context,
+                                     LEGACY_KDF,
+                                     masterkey_provider)
+from collections import Counter
+from cryptography.fernet import InvalidToken
+from django.db import connection, transaction
+from django.db.models import Manager
+from django.utils import timezone
+from rest_framework import status
+from core.serializers import SparseFieldsMixin
+from rest_framework.serializers import (CharField, IntegerField, ListSerializer, ModelSerializer, Serializer,
+                                        SlugRelatedField, UUIDField, ValidationError)
 from taggit_serializer.serializers import TagListSerializerField, TaggitSerializer
 from uuid import uuid4
 
@@ -29,72 +43,372 @@ class PasswordACLSerializer(ModelSerializer):
         fields = ('id', 'user', 'password', 'key', 'api')
 
     def __init__(self, *args, **kwargs):
-        user = kwargs['context']['request'].user
+        request = kwargs['context']['request']
 
         super(PasswordACLSerializer, self).__init__(*args, **kwargs)
         try:
-            placl = PasswordFolderACL.objects.select_related('folder').filter(user_id=user, level__name__in=['Owner', 'Admin'])
-            folder_list = []
-            for p in placl:
-                folder_list.append(p.folder_id)
-            self.fields['password'].queryset = Password.objects.filter(folder__in=folder_list)
+            self.fields['password'].queryset = Password.objects.filter(
+                folder__in=get_acl_folders(request, AccessLevel.ADMIN).values('id'))
         except (PasswordFolderACL.DoesNotExist, TypeError):
             self.fields['password'].queryset = None
 
 
-class PasswordSerializer( ModelSerializer, TaggitSerializer):
+class PasswordListSerializer(ListSerializer):
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, Manager) else data
+        passwords = list(iterable)
+        if 'password' in self.child.fields:
+            self.child.decrypt_many(passwords)
+        return [self.child.to_representation(item) for item in passwords]
+
+
+class PasswordSerializer(SparseFieldsMixin, ModelSerializer, TaggitSerializer):
     tags = TagListSerializerField()
+    # stored encrypted in `secret`, so not bound by the length of the legacy column
+    password = CharField()
 
     class Meta:
         model = Password
         fields = ('id', 'type', 'name', 'description', 'url', 'username', 'password', 'folder', 'tags', 'created',
                   'modified')
+        list_serializer_class = PasswordListSerializer
+
+    @property
+    def keys(self):
+        return get_key_context(self.context['request'])
+
+    def get_decrypt_job(self, obj):
+        """
+        Return the (decrypt, key, secret) job that opens `obj`, or None if it needs the legacy path.
+        """
+        scheme = obj.get_scheme()
+        try:
+            if scheme == Password.SCHEME_AEAD:
+                for key_id, aead_key in self.keys.get_aead_keys(obj.folder):
+                    if key_id == obj.key_id:
+                        return decrypt_aead, aead_key, obj.secret
+                raise InvalidToken
+            if scheme in (Password.SCHEME_FOLDERKEY, None):
+                keys = self.keys.get_folder_keys(obj.folder)
+                if obj.key_id and obj.key_id != keys['key_id']:
+                    raise InvalidToken
+                return decrypt_secret, keys['fernet'], obj.password
+        except PasswordFolderACL.DoesNotExist:
+            if scheme == Password.SCHEME_AEAD:
+                raise InvalidToken
+        return None
+
+    def decrypt_legacy(self, obj):
+        return decrypt_password(masterkey_provider.get_fernet(obj.key_id), self.keys.personalkey(LEGACY_KDF),
+                                obj.password)
+
+    def decrypt(self, obj):
+        scheme = obj.get_scheme()
+        if scheme == Password.SCHEME_PLAINTEXT:
+            return obj.password
+        if scheme == Password.SCHEME_LEGACY:
+            return self.decrypt_legacy(obj)
+        job = self.get_decrypt_job(obj)
+        if job is None:
+            return self.decrypt_legacy(obj)
+        decrypt, key, secret = job
+        if scheme is None:
+            # not backfilled yet: either the folder key or the legacy keys
+            try:
+                return decrypt(key, secret)
+            except InvalidToken:
+                return self.decrypt_legacy(obj)
+        return decrypt(key, secret)
+
+    def encrypt(self, folder, secret):
+        """
+        Return the field values storing `secret` as a single pass AEAD ciphertext.
+        """
+        key_id, aead_key = self.keys.get_aead_keys(folder)[0]
+        return {'password': '',
+                'secret': encrypt_aead(aead_key, secret),
+                'scheme': Password.SCHEME_AEAD,
+                'key_id': key_id}
+
+    def decrypt_many(self, passwords):
+        """
+        Decrypt the secrets of a page of passwords in one batch; rows that cannot be opened this way are
+        left for the serial path in to_representation.
+        """
+        jobs = []
+        pending = []
+        for obj in passwords:
+            if obj.get_scheme() in (Password.SCHEME_PLAINTEXT, Password.SCHEME_LEGACY):
+                continue
+            try:
+                job = self.get_decrypt_job(obj)
+            except InvalidToken:
+                continue
+            if job is not None:
+                jobs.append(job)
+                pending.append(obj)
+        for obj, secret in zip(pending, decrypt_secrets(jobs)):
+            if secret is not None:
+                obj.password = secret
+                obj.decrypted = True
 
     def create(self, validated_data):
-        user = User.objects.get(username=self.context['request'].user)
-        validated_data['password'] = encrypt_password(generate_masterkey('28beatty'),
-                                                   generate_personalkey(user.uuid, user.password),
-                                                   validated_data['password'])
+        validated_data.update(self.encrypt(validated_data['folder'], validated_data['password']))
         password = super(PasswordSerializer, self).create(validated_data)
         return password
 
     def update(self, instance, validated_data):
-        user = User.objects.get(username=self.context['request'].user)
-        password = encrypt_password(generate_masterkey('28beatty'),
-                                                   generate_personalkey(user.uuid, user.password),
-                                                   validated_data.get('password', instance.password))
+        if 'password' not in validated_data:
+            validated_data['password'] = self.decrypt(instance)
         instance.name = validated_data.get('name', instance.name)
         instance.description = validated_data.get('description', instance.description)
         instance.url = validated_data.get('url', instance.url)
         instance.username = validated_data.get('username', instance.username)
-        instance.password = password
         instance.folder = validated_data.get('folder', instance.folder)
+        for field, value in self.encrypt(instance.folder, validated_data['password']).items():
+            setattr(instance, field, value)
         instance.type = validated_data.get('type', instance.type)
         instance.save()
         return instance
 
     def to_representation(self, obj):
-        user = User.objects.get(username=self.context['request'].user)
-        if 'gAAA' in obj.password:
-            obj.password = decrypt_password(generate_masterkey('28beatty'),
-                                            generate_personalkey(user.uuid, user.password),
-                                            obj.password)
-        else:
-            pass
+        if 'password' in self.fields and not getattr(obj, 'decrypted', False):
+            try:
+                obj.password = self.decrypt(obj)
+            except InvalidToken:
+                if self.parent is None:
+                    raise
+                # listed through a password ACL without a key to its folder
+                obj.password = None
+            obj.decrypted = True
         instance = super(PasswordSerializer, self).to_representation(obj)
         return instance
 
 
     def __init__(self, *args, **kwargs):
-        user = kwargs['context']['request'].user
+        request = kwargs['context']['request']
 
         super(PasswordSerializer, self).__init__(*args, **kwargs)
+        if 'folder' not in self.fields:
+            return
         try:
-            placl = PasswordFolderACL.objects.select_related('folder').filter(user_id=user,
-                                                                              level__name__in=['Owner', 'Admin'])
-            folder_list = []
-            for p in placl:
-                folder_list.append(p.folder_id)
-            self.fields['folder'].queryset = PasswordFolder.objects.filter(id__in=folder_list)
+            self.fields['folder'].queryset = get_acl_folders(request, AccessLevel.ADMIN)
         except (PasswordFolderACL.DoesNotExist, TypeError):
             self.fields['folder'].queryset = None
+
+
+class PasswordMetadataSerializer(SparseFieldsMixin, TaggitSerializer, ModelSerializer):
+    tags = TagListSerializerField()
+
+    class Meta:
+        model = Password
+        fields = ('id', 'type', 'name', 'description', 'url', 'username', 'folder', 'tags', 'created', 'modified')
+        read_only_fields = fields
+
+
+class PasswordSecretSerializer(PasswordSerializer):
+
+    class Meta(PasswordSerializer.Meta):
+        fields = ('id', 'password')
+
+
+class PasswordBulkItemSerializer(Serializer):
+    """
+    One password of a bulk write. Folder and type are plain ids: the folders of the whole batch are loaded and
+    checked once by PasswordBulkSerializer instead of one query per item.
+    """
+    id = IntegerField(required=False)
+    type = IntegerField(required=False, allow_null=True)
+    name = CharField(max_length=100)
+    description = CharField(max_length=1024)
+    url = CharField(max_length=1024, required=False, allow_null=True)
+    username = CharField(max_length=50)
+    password = CharField()
+    folder = IntegerField()
+    tags = TagListSerializerField(required=False)
+
+    def validate_type(self, value):
+        if value is None:
+            return value
+        try:
+            return password_types.get(pk=value).pk
+        except PasswordType.DoesNotExist:
+            raise ValidationError('Invalid pk "{}" - object does not exist.'.format(value))
+
+
+class PasswordBulkSerializer(object):
+    """
+    Create, update and delete many passwords in one transaction.
+
+    The caller's access to every folder involved is read with one query and the folder keys are derived once per
+    folder; rows are written with bulk_create, bulk_update and a single delete. `apply()` returns one result per
+    item, in request order, with the status the single password endpoint would have answered.
+    """
+    columns = ('name', 'description', 'url', 'username', 'type', 'folder', 'password', 'secret', 'scheme', 'key_id',
+               'modified')
+
+    def __init__(self, data, context):
+        self.data = data
+        self.context = context
+        self.request = context['request']
+        # encrypts and decrypts with the request's key context, shared by every item
+        self.secrets = PasswordSerializer(context=context)
+
+    def get_items(self, key):
+        items = self.data.get(key) or []
+        if not isinstance(items, list):
+            raise ValidationError({key: ['Expected a list.']})
+        return items
+
+    def apply(self):
+        creates = self.get_items('create')
+        updates = self.get_items('update')
+        deletes = self.get_items('delete')
+        results = {'create': [None] * len(creates), 'update': [None] * len(updates), 'delete': [None] * len(deletes)}
+
+        created = []
+        for i, item in enumerate(creates):
+            serializer = PasswordBulkItemSerializer(data=item)
+            if serializer.is_valid():
+                created.append((i, serializer.validated_data))
+            else:
+                results['create'][i] = {'status': status.HTTP_400_BAD_REQUEST, 'errors': serializer.errors}
+        updated = []
+        for i, item in enumerate(updates):
+            serializer = PasswordBulkItemSerializer(data=item, partial=True)
+            if not serializer.is_valid():
+                results['update'][i] = {'status': status.HTTP_400_BAD_REQUEST, 'errors': serializer.errors}
+            elif 'id' not in serializer.validated_data:
+                results['update'][i] = {'status': status.HTTP_400_BAD_REQUEST,
+                                        'errors': {'id': ['This field is required.']}}
+            else:
+                updated.append((i, serializer.validated_data))
+        deleted = []
+        for i, pk in enumerate(deletes):
+            if isinstance(pk, int) and not isinstance(pk, bool):
+                deleted.append((i, pk))
+            else:
+                results['delete'][i] = {'status': status.HTTP_400_BAD_REQUEST, 'errors': ['Expected a password id.']}
+        # a password is updated or deleted at most once per request
+        counts = Counter([data['id'] for i, data in updated] + [pk for i, pk in deleted])
+        for key, items, get_pk in (('update', updated, lambda data: data['id']), ('delete', deleted, lambda pk: pk)):
+            for i, item in items:
+                if counts[get_pk(item)] > 1:
+                    results[key][i] = {'status': status.HTTP_400_BAD_REQUEST, 'id': get_pk(item),
+                                       'errors': ['The id appears more than once in this request.']}
+        updated = [(i, data) for i, data in updated if counts[data['id']] == 1]
+        deleted = [(i, pk) for i, pk in deleted if counts[pk] == 1]
+
+        existing = Password.objects.select_related('folder').in_bulk(
+            [data['id'] for i, data in updated] + [pk for i, pk in deleted])
+        folder_ids = {data['folder'] for i, data in created + updated if 'folder' in data}
+        folder_ids |= {password.folder_id for password in existing.values()}
+        folders = PasswordFolder.objects.in_bulk(folder_ids)
+        ranks = dict(PasswordFolderAccess.objects.filter(user=self.request.user, folder_id__in=folder_ids)
+                     .values_list('folder_id', 'level__rank'))
+
+        def allowed(folder_id, rank):
+            return ranks.get(folder_id, 0) >= rank
+
+        with transaction.atomic():
+            self.create(created, folders, allowed, results['create'])
+            self.update(updated, existing, folders, allowed, results['update'])
+            self.delete(deleted, existing, allowed, results['delete'])
+        return results
+
+    def encrypt(self, password, folder, secret):
+        for field, value in self.secrets.encrypt(folder, secret).items():
+            setattr(password, field, value)
+
+    def key_error(self, error, pk=None):
+        """
+        Result of an item whose folder key is out of reach, or whose stored secret that key cannot open.
+        """
+        if isinstance(error, PasswordFolderACL.DoesNotExist):
+            result = {'status': status.HTTP_403_FORBIDDEN, 'errors': ['The folder key is not available.']}
+        else:
+            result = {'status': status.HTTP_422_UNPROCESSABLE_ENTITY, 'errors': ['The secret cannot be decrypted.']}
+        if pk is not None:
+            result['id'] = pk
+        return result
+
+    def create(self, created, folders, allowed, results):
+        passwords = []
+        for i, data in created:
+            if data['folder'] not in folders or not allowed(data['folder'], AccessLevel.ADMIN):
+                results[i] = {'status': status.HTTP_403_FORBIDDEN}
+                continue
+            password = Password(name=data['name'], description=data['description'], url=data.get('url'),
+                                username=data['username'], type_id=data.get('type'), folder_id=data['folder'])
+            try:
+                self.encrypt(password, folders[data['folder']], data['password'])
+            except (InvalidToken, PasswordFolderACL.DoesNotExist) as e:
+                results[i] = self.key_error(e)
+                continue
+            passwords.append((i, password, data.get('tags')))
+        if connection.features.can_return_ids_from_bulk_insert:
+            Password.objects.bulk_create([password for i, password, tags in passwords])
+        else:
+            # the backend cannot report the ids of a bulk insert, which the results and tags need
+            for i, password, tags in passwords:
+                password.save()
+        for i, password, tags in passwords:
+            if tags:
+                password.tags.set(*tags)
+            results[i] = {'status': status.HTTP_201_CREATED, 'id': password.pk}
+
+    def update(self, updated, existing, folders, allowed, results):
+        passwords = []
+        now = timezone.now()
+        for i, data in updated:
+            password = existing.get(data['id'])
+            if password is None:
+                results[i] = {'status': status.HTTP_404_NOT_FOUND, 'id': data['id']}
+                continue
+            folder_id = data.get('folder', password.folder_id)
+            # moving a password needs the rights to create it in the target folder
+            if not allowed(password.folder_id, AccessLevel.MODIFY) or \
+                    (folder_id != password.folder_id and (folder_id not in folders or
+                                                          not allowed(folder_id, AccessLevel.ADMIN))):
+                results[i] = {'status': status.HTTP_403_FORBIDDEN, 'id': data['id']}
+                continue
+            secret = data.get('password')
+            try:
+                if secret is None and folder_id != password.folder_id:
+                    # the ciphertext is bound to the folder key
+                    secret = self.secrets.decrypt(password)
+                if secret is not None:
+                    self.encrypt(password, folders[folder_id], secret)
+            except (InvalidToken, PasswordFolderACL.DoesNotExist) as e:
+                results[i] = self.key_error(e, data['id'])
+                continue
+            for field in ('name', 'description', 'url', 'username'):
+                setattr(password, field, data.get(field, getattr(password, field)))
+            password.type_id = data.get('type', password.type_id)
+            password.folder_id = folder_id
+            password.modified = now
+            passwords.append((i, password, data.get('tags')))
+        bulk_update(Password, [password for i, password, tags in passwords], self.columns)
+        for i, password, tags in passwords:
+            if tags is not None:
+                password.tags.set(*tags)
+            results[i] = {'status': status.HTTP_202_ACCEPTED, 'id': password.pk}
+
+    def delete(self, deleted, existing, allowed, results):
+        pks = []
+        shared = set(PasswordACL.objects.filter(password__in=[pk for i, pk in deleted])
+                     .values_list('password_id', flat=True))
+        for i, pk in deleted:
+            password = existing.get(pk)
+            if password is None:
+                results[i] = {'status': status.HTTP_404_NOT_FOUND, 'id': pk}
+            elif not allowed(password.folder_id, AccessLevel.ADMIN):
+                results[i] = {'status': status.HTTP_403_FORBIDDEN, 'id': pk}
+            elif pk in shared:
+                # password ACLs protect the row; revoke them first
+                results[i] = {'status': status.HTTP_409_CONFLICT, 'id': pk}
+            else:
+                pks.append(pk)
+                results[i] = {'status': status.HTTP_204_NO_CONTENT, 'id': pk}
+        Password.objects.filter(pk__in=pks).delete()
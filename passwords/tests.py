@@ -1,9 +1,22 @@
+import json
+from io import StringIO
+from unittest import mock
+from urllib.parse import parse_qs, urlparse
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from rest_framework import status
 from rest_framework.test import force_authenticate, APITestCase, APIClient, APIRequestFactory
 from core.models import User, Owner, AccessLevel
+from core.scripts.bulk import bulk_update
+from core.scripts.encryption import encrypt_password, KeyContext, LEGACY_KDF, masterkey_provider, personalkey_cache
 from passwordfolders.models import PasswordFolder, PasswordFolderACL
+from passwordfolders.views import PasswordFolderACLViewSet
 from passwords.models import Password, PasswordACL, PasswordType
+from passwords.serializers import PasswordSerializer
 from passwords.views import PasswordViewSet, PasswordACLViewSet
 
 
@@ -128,6 +141,89 @@ class PasswordAPITestCase(APITestCase):
         response = view(request, pk=1)
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
 
+    # Create, update and delete many passwords at once with a result per item
+    def test_password_bulk(self):
+        user = User.objects.get(username='regular')
+        other = User.objects.create_user(username='other', password='Welcome2', email='other@user.com')
+        personal = PasswordFolder.objects.get(name='Personal', user=user)
+        shared = PasswordFolder.objects.get(name='Shared')
+        foreign = PasswordFolder.objects.get(name='Personal', user=other)
+        item = {'name': 'Bulk', 'description': 'Bulk Password', 'type': 1, 'username': 'bulk', 'url': 'http://bulk.com'}
+        data = {'create': [dict(item, password='first', folder=shared.pk, tags=['bulk']),
+                           dict(item, password='second', folder=personal.pk),
+                           dict(item, password='third', folder=foreign.pk),
+                           dict(item, folder=shared.pk)],
+                'update': [{'id': 2, 'name': 'Renamed'},
+                           {'id': 1, 'folder': shared.pk},
+                           {'name': 'No id'}],
+                'delete': [999, 'x']}
+        view = PasswordViewSet.as_view({'post': 'bulk'})
+        request = APIRequestFactory().post(reverse('password:password-bulk'), data, format='json')
+        force_authenticate(request, user=user)
+        response = view(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([r['status'] for r in response.data['create']], [201, 201, 403, 400])
+        self.assertEqual([r['status'] for r in response.data['update']], [202, 202, 400])
+        self.assertEqual([r['status'] for r in response.data['delete']], [404, 400])
+        first = Password.objects.get(pk=response.data['create'][0]['id'])
+        self.assertEqual(list(first.tags.names()), ['bulk'])
+        self.assertEqual(Password.objects.get(pk=2).name, 'Renamed')
+        self.assertEqual(Password.objects.get(pk=1).folder, shared)
+
+        request = APIRequestFactory().post(reverse('password:password-reveal-many'),
+                                           {'ids': [1, 2, first.pk]}, format='json')
+        force_authenticate(request, user=user)
+        response = PasswordViewSet.as_view({'post': 'reveal_many'})(request)
+        self.assertEqual({r['id']: r['password'] for r in response.data},
+                         {1: '123456', 2: '12345678', first.pk: 'first'})
+
+        request = APIRequestFactory().post(reverse('password:password-bulk'), {'delete': [first.pk]}, format='json')
+        force_authenticate(request, user=other)
+        self.assertEqual(view(request).data['delete'][0]['status'], 403)
+        request = APIRequestFactory().post(reverse('password:password-bulk'), {'delete': [first.pk]}, format='json')
+        force_authenticate(request, user=user)
+        self.assertEqual(view(request).data['delete'][0]['status'], 204)
+        self.assertFalse(Password.objects.filter(pk=first.pk).exists())
+
+    # A bulk update whose rows all have no type writes NULL to every row of the column
+    def test_password_bulk_update_untyped(self):
+        user = User.objects.get(username='regular')
+        Password.objects.filter(pk__in=[1, 2]).update(type=None)
+        data = {'update': [{'id': 1, 'name': 'First'}, {'id': 2, 'name': 'Second'}]}
+        request = APIRequestFactory().post(reverse('password:password-bulk'), data, format='json')
+        force_authenticate(request, user=user)
+        response = PasswordViewSet.as_view({'post': 'bulk'})(request)
+        self.assertEqual([r['status'] for r in response.data['update']], [202, 202])
+        self.assertEqual(list(Password.objects.filter(pk__in=[1, 2]).order_by('pk').values_list('name', 'type')),
+                         [('First', None), ('Second', None)])
+
+    # Duplicate ids and secrets that cannot be opened are reported per item instead of failing the batch
+    def test_password_bulk_item_failures(self):
+        user = User.objects.get(username='regular')
+        personal = PasswordFolder.objects.get(name='Personal', user=user)
+        shared = PasswordFolder.objects.get(name='Shared')
+        Password.objects.filter(pk=2).update(secret=b'garbage', scheme=Password.SCHEME_AEAD, key_id='unknown')
+        view = PasswordViewSet.as_view({'post': 'bulk'})
+        data = {'update': [{'id': 1, 'name': 'Once'}, {'id': 1, 'name': 'Twice'}, {'id': 2, 'folder': personal.pk}],
+                'delete': [1]}
+        request = APIRequestFactory().post(reverse('password:password-bulk'), data, format='json')
+        force_authenticate(request, user=user)
+        response = view(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([r['status'] for r in response.data['update']], [400, 400, 422])
+        self.assertEqual([r['status'] for r in response.data['delete']], [400])
+        self.assertEqual(Password.objects.get(pk=1).name, 'Test Personal')
+        self.assertEqual(Password.objects.get(pk=2).folder, shared)
+
+        item = {'name': 'Bulk', 'description': 'Bulk Password', 'username': 'bulk', 'password': 'x',
+                'folder': shared.pk}
+        request = APIRequestFactory().post(reverse('password:password-bulk'), {'create': [item]}, format='json')
+        force_authenticate(request, user=user)
+        with mock.patch.object(KeyContext, 'get_folder_keys', side_effect=PasswordFolderACL.DoesNotExist):
+            response = view(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['create'][0]['status'], status.HTTP_403_FORBIDDEN)
+
 
 class PasswordACLAPITestCase(APITestCase):
     fixtures = ['owner.yaml', 'passwordtype.yaml', 'accesslevel.yaml']
@@ -232,4 +328,427 @@ class PasswordACLAPITestCase(APITestCase):
         request = factory.post(url)
         force_authenticate(request, user=user)
         response = view(request, pk=1)
-        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+
+
+    # Password ACLs are listed and retrieved only by their user and the Owners and Admins of the password's folder
+    def test_passwordacl_list_scope(self):
+        user = User.objects.get(username='regular')
+        service = User.objects.get(username='service')
+        reader = User.objects.create_user(username='reader', password='Welcome2', email='reader@user.com')
+        PasswordFolderACL.objects.create(user=reader, folder=PasswordFolder.objects.get(name='Shared'),
+                                         level=AccessLevel.objects.get(name='Read'))
+        view = PasswordACLViewSet.as_view({'get': 'list'})
+        listed = {}
+        for who in (user, service, reader):
+            request = APIRequestFactory().get(reverse('password:passwordacl-list'))
+            force_authenticate(request, user=who)
+            listed[who.username] = [acl['user'] for acl in view(request).data['results']]
+        self.assertEqual(listed, {'regular': [service.pk], 'service': [service.pk], 'reader': []})
+        # retrieving the same rows by id follows the same rule
+        acl = PasswordACL.objects.get(user=service)
+        view = PasswordACLViewSet.as_view({'get': 'retrieve'})
+        retrieved = {}
+        for who in (user, service, reader):
+            request = APIRequestFactory().get(reverse('password:passwordacl-detail', args=(acl.pk,)))
+            force_authenticate(request, user=who)
+            retrieved[who.username] = view(request, pk=acl.pk).status_code
+        self.assertEqual(retrieved, {'regular': status.HTTP_200_OK, 'service': status.HTTP_200_OK,
+                                     'reader': status.HTTP_403_FORBIDDEN})
+
+    # A password shared through a password ACL can be opened by its grantee
+    def test_passwordacl_grantee_reveal(self):
+        user = User.objects.get(username='regular')
+        service = User.objects.get(username='service')
+        request = APIRequestFactory().post(reverse('password:password-list'), {
+            'name': 'Encrypted', 'description': 'Encrypted Password', 'type': '1', 'username': 'enc',
+            'password': 'granted-secret', 'url': 'http://enc.com',
+            'folder': PasswordFolder.objects.get(name='Shared').pk, 'tags': []})
+        force_authenticate(request, user=user)
+        password = Password.objects.get(pk=PasswordViewSet.as_view({'post': 'create'})(request).data['id'])
+        self.assertEqual(password.scheme, Password.SCHEME_AEAD)
+        PasswordACL.objects.create(user=service, password=password)
+
+        request = APIRequestFactory().get(reverse('password:password-reveal', args=(password.pk,)))
+        force_authenticate(request, user=service)
+        response = PasswordViewSet.as_view({'get': 'reveal'})(request, pk=password.pk)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['password'], 'granted-secret')
+        request = APIRequestFactory().get(reverse('password:password-list'))
+        force_authenticate(request, user=service)
+        response = PasswordViewSet.as_view({'get': 'list'})(request)
+        self.assertEqual({p['name']: p['password'] for p in response.data['results']}['Encrypted'], 'granted-secret')
+
+
+class PasswordEnvelopeTestCase(APITestCase):
+    fixtures = ['owner.yaml', 'passwordtype.yaml', 'accesslevel.yaml']
+
+    def setUp(self):
+        User.objects.create_user(username='regular', password='Welcome2', email='regular@user.com')
+        User.objects.create_user(username='second', password='Welcome2', email='second@user.com')
+        user = User.objects.get(username='regular')
+        shared = Owner.objects.get(name='Default')
+        PasswordFolder.objects.create(name='Shared', description='Shared Folder', owner=shared, parent=None, user=user)
+        shared_folder = PasswordFolder.objects.get(name='Shared')
+        PasswordFolderACL.objects.create(user=user, folder=shared_folder, level=AccessLevel.objects.get(name='Owner'))
+
+    def create_password(self, user, folder):
+        factory = APIRequestFactory()
+        view = PasswordViewSet.as_view({'post': 'create'})
+        data = {
+            'name': 'Test Password',
+            'description': 'Test Password Addition',
+            'type': '1',
+            'username': 'test_create',
+            'password': 's3cret',
+            'url': 'http://create.com',
+            'folder': str(folder.pk),
+            'tags': []
+        }
+        request = factory.post(reverse('password:password-list'), data)
+        force_authenticate(request, user=user)
+        return view(request)
+
+    def retrieve_password(self, user, pk):
+        factory = APIRequestFactory()
+        view = PasswordViewSet.as_view({'get': 'retrieve'})
+        request = factory.get(reverse('password:password-detail', args=(pk,)))
+        force_authenticate(request, user=user)
+        return view(request, pk=pk)
+
+    # Secrets are encrypted with the folder data key and readable by every ACL holder
+    def test_password_shared_with_acl_holder(self):
+        user = User.objects.get(username='regular')
+        second = User.objects.get(username='second')
+        folder = PasswordFolder.objects.get(name='Shared')
+        response = self.create_password(user, folder)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Password.objects.get().scheme, Password.SCHEME_AEAD)
+        self.assertNotIn(b's3cret', bytes(Password.objects.get().secret))
+        PasswordFolderACL.objects.create(user=second, folder=folder, level=AccessLevel.objects.get(name='Read'))
+        self.assertEqual(PasswordFolderACL.objects.filter(folder=folder, wrapped_key__isnull=True).count(), 0)
+        response = self.retrieve_password(second, Password.objects.get().pk)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['password'], 's3cret')
+
+    # Revoking the ACL removes the holder's wrapped data key
+    def test_password_revoked_acl_holder(self):
+        user = User.objects.get(username='regular')
+        second = User.objects.get(username='second')
+        folder = PasswordFolder.objects.get(name='Shared')
+        acl = PasswordFolderACL.objects.create(user=second, folder=folder, level=AccessLevel.objects.get(name='Read'))
+        self.create_password(user, folder)
+        acl.delete()
+        with self.assertRaises(PasswordFolderACL.DoesNotExist):
+            folder.get_datakey(second)
+
+    # Changing a holder's password re-wraps their data keys
+    def test_password_survives_password_change(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        self.create_password(user, folder)
+        user.set_password('Welcome3')
+        user.save()
+        response = self.retrieve_password(User.objects.get(username='regular'), Password.objects.get().pk)
+        self.assertEqual(response.data['password'], 's3cret')
+
+    # Lists above the batch cutoff are decrypted through the thread pool
+    @override_settings(DECRYPT_WORKERS=2, DECRYPT_BATCH_MIN=2)
+    def test_password_list_batch_decrypt(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        for i in range(3):
+            self.create_password(user, folder)
+        factory = APIRequestFactory()
+        view = PasswordViewSet.as_view({'get': 'list'})
+        request = factory.get(reverse('password:password-list'))
+        force_authenticate(request, user=user)
+        response = view(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([p['password'] for p in response.data['results']], ['s3cret'] * 3)
+
+    # The requesting user and their keys are loaded once per request, not once per row
+    def test_password_list_user_queries(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        personalkey = personalkey_cache.get(user.uuid, user.password, LEGACY_KDF)
+        for i in range(20):
+            Password.objects.create(name='Legacy', description='Legacy Password', username='legacy', folder=folder,
+                                    password=encrypt_password(masterkey_provider.fernet, personalkey, 'legacy'),
+                                    scheme=Password.SCHEME_LEGACY)
+        view = PasswordViewSet.as_view({'get': 'list'})
+        request = APIRequestFactory().get(reverse('password:password-list'))
+        force_authenticate(request, user=user)
+        with CaptureQueriesContext(connection) as queries:
+            response = view(request)
+        self.assertEqual([p['password'] for p in response.data['results']], ['legacy'] * 20)
+        self.assertEqual([q['sql'] for q in queries if 'FROM "auth_user"' in q['sql']], [])
+
+    # Tags are prefetched, so listing more passwords does not add queries
+    def test_password_list_query_count(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        view = PasswordViewSet.as_view({'get': 'list'})
+        counts = []
+        for size in (2, 6):
+            while Password.objects.count() < size:
+                self.create_password(user, folder)
+                Password.objects.latest('pk').tags.add('tag{}'.format(Password.objects.count()), 'shared')
+            request = APIRequestFactory().get(reverse('password:password-list'))
+            force_authenticate(request, user=user)
+            with CaptureQueriesContext(connection) as queries:
+                response = view(request)
+            self.assertEqual(len(response.data['results']), size)
+            self.assertEqual(len(response.data['results'][0]['tags']), 2)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    # Lists are cursor paginated and following `next` visits every password once
+    def test_password_list_cursor_pagination(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        for i in range(5):
+            self.create_password(user, folder)
+        view = PasswordViewSet.as_view({'get': 'list'})
+        params = {'page_size': 2}
+        seen = []
+        while params is not None:
+            request = APIRequestFactory().get(reverse('password:password-list'), params)
+            force_authenticate(request, user=user)
+            response = view(request)
+            self.assertLessEqual(len(response.data['results']), 2)
+            seen.extend(p['id'] for p in response.data['results'])
+            params = parse_qs(urlparse(response.data['next']).query) if response.data['next'] else None
+        self.assertEqual(sorted(seen), sorted(Password.objects.values_list('pk', flat=True)))
+
+    # Rows written by one bulk update share `modified`; pages break the tie on id both ways
+    def test_password_list_cursor_pagination_ties(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        for i in range(7):
+            self.create_password(user, folder)
+        passwords = list(Password.objects.all())
+        now = timezone.now()
+        for password in passwords:
+            password.modified = now
+        bulk_update(Password, passwords, ['modified'])
+        view = PasswordViewSet.as_view({'get': 'list'})
+
+        def page(params):
+            request = APIRequestFactory().get(reverse('password:password-list'), params)
+            force_authenticate(request, user=user)
+            return view(request).data
+
+        def params(link):
+            return parse_qs(urlparse(link).query) if link else None
+
+        pages = [page({'page_size': 2})]
+        while pages[-1]['next']:
+            pages.append(page(params(pages[-1]['next'])))
+        seen = [p['id'] for data in pages for p in data['results']]
+        self.assertEqual(seen, sorted(Password.objects.values_list('pk', flat=True), reverse=True))
+        backwards = []
+        data = pages[-1]
+        while data['previous']:
+            data = page(params(data['previous']))
+            backwards[:0] = [p['id'] for p in data['results']]
+        self.assertEqual(backwards + [p['id'] for p in pages[-1]['results']], seen)
+
+    # A cursor that does not decode to a full position is an invalid cursor, not a server error
+    def test_password_list_invalid_cursor(self):
+        user = User.objects.get(username='regular')
+        view = PasswordViewSet.as_view({'get': 'list'})
+        for cursor in ('garbage', 'cD0yMDI2LTEwLTE4'):
+            request = APIRequestFactory().get(reverse('password:password-list'), {'cursor': cursor})
+            force_authenticate(request, user=user)
+            self.assertEqual(view(request).status_code, status.HTTP_404_NOT_FOUND)
+
+    # ?fields= trims the serialized fields and the columns loaded, without decrypting unrequested secrets
+    def test_password_list_sparse_fields(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        self.create_password(user, folder)
+        view = PasswordViewSet.as_view({'get': 'list'})
+        request = APIRequestFactory().get(reverse('password:password-list'), {'fields': 'id,name,folder'})
+        force_authenticate(request, user=user)
+        with CaptureQueriesContext(connection) as queries:
+            response = view(request)
+        self.assertEqual(set(response.data['results'][0]), {'id', 'name', 'folder'})
+        # no data key unwrapping and no tag prefetch
+        sql = ' '.join(q['sql'] for q in queries)
+        self.assertNotIn('"description"', sql)
+        self.assertNotIn('wrapped_key', sql)
+        self.assertNotIn('taggit', sql)
+
+        request = APIRequestFactory().get(reverse('password:password-list'), {'exclude': 'tags,url'})
+        force_authenticate(request, user=user)
+        response = view(request)
+        self.assertNotIn('url', response.data['results'][0])
+        self.assertEqual(response.data['results'][0]['password'], 's3cret')
+
+    # Polling an unchanged list answers 304 without decrypting; any change produces a new ETag
+    def test_password_list_etag(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        self.create_password(user, folder)
+        view = PasswordViewSet.as_view({'get': 'list'})
+        request = APIRequestFactory().get(reverse('password:password-list'))
+        force_authenticate(request, user=user)
+        response = view(request)
+        etag = response['ETag']
+        self.assertIn('Authorization', response['Vary'])
+        request = APIRequestFactory().get(reverse('password:password-list'), HTTP_IF_NONE_MATCH=etag)
+        force_authenticate(request, user=user)
+        with mock.patch.object(PasswordSerializer, 'decrypt_many') as decrypt_many:
+            response = view(request)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+        decrypt_many.assert_not_called()
+        Password.objects.get().delete()
+        request = APIRequestFactory().get(reverse('password:password-list'), HTTP_IF_NONE_MATCH=etag)
+        force_authenticate(request, user=user)
+        response = view(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    # ?stream=true writes the whole list as one JSON array, decrypted and tagged chunk by chunk
+    @override_settings(STREAM_CHUNK_SIZE=2)
+    def test_password_list_stream(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        for i in range(3):
+            self.create_password(user, folder)
+        Password.objects.latest('pk').tags.add('shared')
+        view = PasswordViewSet.as_view({'get': 'list'})
+        request = APIRequestFactory().get(reverse('password:password-list'), {'stream': 'true'})
+        force_authenticate(request, user=user)
+        response = view(request)
+        self.assertTrue(response.streaming)
+        passwords = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        self.assertEqual([p['password'] for p in passwords], ['s3cret'] * 3)
+        self.assertEqual(passwords[-1]['tags'], ['shared'])
+
+    # Folder ACLs, personal folders and password ACLs make a password visible, each password listed once
+    def test_password_visible_to(self):
+        user = User.objects.get(username='regular')
+        second = User.objects.get(username='second')
+        folder = PasswordFolder.objects.get(name='Shared')
+        self.create_password(user, folder)
+        password = Password.objects.get()
+        PasswordACL.objects.create(user=user, password=password)
+        self.assertEqual(list(Password.objects.visible_to(user)), [password])
+        self.assertEqual(list(Password.objects.visible_to(second)), [])
+        PasswordACL.objects.create(user=second, password=password)
+        self.assertEqual(list(Password.objects.visible_to(second)), [password])
+        view = PasswordViewSet.as_view({'get': 'list'})
+        request = APIRequestFactory().get(reverse('password:password-list'))
+        force_authenticate(request, user=second)
+        response = view(request)
+        # the folder's data key is unwrapped for the password ACL grantee
+        self.assertEqual([(p['id'], p['password']) for p in response.data['results']], [(password.pk, 's3cret')])
+
+    # Revoking every direct ACL of a child folder through inherited rights keeps its data key wrapped for the caller
+    def test_password_inherited_owner_revokes_direct_acls(self):
+        user = User.objects.get(username='regular')
+        second = User.objects.get(username='second')
+        shared = PasswordFolder.objects.get(name='Shared')
+        owner = AccessLevel.objects.get(name='Owner')
+        revoke = PasswordFolderACLViewSet.as_view({'post': 'revoke'})
+        destroy = PasswordFolderACLViewSet.as_view({'delete': 'destroy'})
+        for name in ('Revoked', 'Destroyed'):
+            child = PasswordFolder.objects.create(name=name, description='Child Folder', parent=shared)
+            acl = PasswordFolderACL.objects.create(user=second, folder=child, level=owner)
+            self.assertEqual(self.create_password(second, child).status_code, status.HTTP_201_CREATED)
+            if name == 'Revoked':
+                request = APIRequestFactory().post(reverse('passwordfolder:passwordfolderacl-revoke'),
+                                                   {'users': [second.pk], 'folders': [child.pk]}, format='json')
+                force_authenticate(request, user=user)
+                self.assertEqual(revoke(request).data, {'created': 0, 'updated': 0, 'deleted': 1})
+            else:
+                request = APIRequestFactory().delete(reverse('passwordfolder:passwordfolderacl-detail',
+                                                             args=(acl.pk,)))
+                force_authenticate(request, user=user)
+                self.assertEqual(destroy(request, pk=acl.pk).status_code, status.HTTP_204_NO_CONTENT)
+            acl = PasswordFolderACL.objects.get(folder=child)
+            self.assertEqual((acl.user, acl.level), (user, owner))
+            password = Password.objects.get(folder=child)
+            self.assertEqual(self.retrieve_password(user, password.pk).data['password'], 's3cret')
+
+        # without access of their own the caller cannot take over the last copy
+        third = User.objects.create_user(username='third', password='Welcome2', email='third@user.com')
+        request = APIRequestFactory().delete(reverse('passwordfolder:passwordfolderacl-detail', args=(acl.pk,)))
+        force_authenticate(request, user=third)
+        self.assertEqual(destroy(request, pk=acl.pk).status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(self.retrieve_password(user, password.pk).data['password'], 's3cret')
+
+    # Metadata listing leaves out the secret and reveal returns it
+    def test_password_metadata_list_and_reveal(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        self.create_password(user, folder)
+        self.create_password(user, folder)
+        factory = APIRequestFactory()
+        view = PasswordViewSet.as_view({'get': 'list'})
+        request = factory.get(reverse('password:password-list'), {'metadata': 'true'})
+        force_authenticate(request, user=user)
+        response = view(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertNotIn('password', response.data['results'][0])
+        pk = response.data['results'][0]['id']
+
+        view = PasswordViewSet.as_view({'get': 'reveal'})
+        request = factory.get(reverse('password:password-reveal', args=(pk,)))
+        force_authenticate(request, user=user)
+        response = view(request, pk=pk)
+        self.assertEqual(response.data, {'id': pk, 'password': 's3cret'})
+
+        view = PasswordViewSet.as_view({'post': 'reveal_many'})
+        ids = list(Password.objects.values_list('pk', flat=True))
+        request = factory.post(reverse('password:password-reveal-many'), {'ids': ids})
+        force_authenticate(request, user=user)
+        response = view(request)
+        self.assertEqual(sorted(p['id'] for p in response.data), sorted(ids))
+        self.assertEqual({p['password'] for p in response.data}, {'s3cret'})
+
+    # New secrets are stored as AEAD ciphertext, without the length limit of the legacy column
+    def test_password_aead_long_secret(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        secret = 'x' * 4096
+        view = PasswordViewSet.as_view({'post': 'create'})
+        request = APIRequestFactory().post(reverse('password:password-list'), {
+            'name': 'Long Password', 'description': 'Long Password', 'type': '1', 'username': 'long',
+            'password': secret, 'url': 'http://long.com', 'folder': str(folder.pk), 'tags': []})
+        force_authenticate(request, user=user)
+        self.assertEqual(view(request).status_code, status.HTTP_201_CREATED)
+        password = Password.objects.get()
+        self.assertEqual(password.password, '')
+        self.assertEqual(bytes(password.secret)[:1], b'\x01')
+        response = self.retrieve_password(user, password.pk)
+        self.assertEqual(response.data['password'], secret)
+
+    # The scheme and key id are recorded on write and backfilled for older rows
+    def test_password_scheme_backfill(self):
+        user = User.objects.get(username='regular')
+        folder = PasswordFolder.objects.get(name='Shared')
+        self.create_password(user, folder)
+        Password.objects.update(scheme=None, key_id='')
+        Password.objects.create(name='Legacy', description='Legacy Password', username='legacy', folder=folder,
+                                password=encrypt_password(masterkey_provider.fernet,
+                                                          personalkey_cache.get(user.uuid, user.password, LEGACY_KDF),
+                                                          'legacy'))
+        Password.objects.create(name='Plain', description='Plain Password', username='plain', folder=folder,
+                                password='plain')
+        call_command('backfill_password_scheme', stdout=StringIO())
+        schemes = dict(Password.objects.values_list('name', 'scheme'))
+        self.assertEqual(schemes, {'Test Password': Password.SCHEME_AEAD,
+                                   'Legacy': Password.SCHEME_LEGACY,
+                                   'Plain': Password.SCHEME_PLAINTEXT})
+        self.assertEqual(Password.objects.get(name='Legacy').key_id, masterkey_provider.key_id)
+        factory = APIRequestFactory()
+        view = PasswordViewSet.as_view({'get': 'list'})
+        request = factory.get(reverse('password:password-list'))
+        force_authenticate(request, user=user)
+        response = view(request)
+        self.assertEqual(sorted(p['password'] for p in response.data['results']), ['legacy', 'plain', 's3cret'])
@@ -1,10 +1,19 @@
-from django.db.models import Q, FieldDoesNotExist
+from django.db.models import FieldDoesNotExist, Q
 from django.http import Http404
 from cryptography.fernet import InvalidToken
 from rest_framework import status, viewsets
+from rest_framework.decorators import action
+from rest_framework.exceptions import APIException, ValidationError
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 
+from core.conditional import list_etag, not_modified, set_reference_cache, set_validators
+from core.models import AccessLevel
+from core.pagination import ModifiedCursorPagination
+from core.registry import password_types
+from core.serializers import sparse_fields
+from core.streaming import iterate_chunks, stream_json_list
+from passwordfolders.models import get_acl_folders
 from passwords.models import Password, PasswordACL, PasswordType
 from passwords.permissions import (CanCreatePassword,
                                    CanListPassword,
@@ -16,7 +25,12 @@ from passwords.permissions import (CanCreatePassword,
                                    CanRetrievePasswordACL,
                                    CanUpdatePasswordACL,
                                    CanDestroyPasswordACL)
-from passwords.serializers import PasswordSerializer, PasswordACLSerializer, PasswordTypeSerializer
+from passwords.serializers import (PasswordSerializer,
+                                   PasswordBulkSerializer,
+                                   PasswordACLSerializer,
+                                   PasswordMetadataSerializer,
+                                   PasswordSecretSerializer,
+                                   PasswordTypeSerializer)
 
 
 # Password View
@@ -24,20 +38,91 @@ class PasswordViewSet(viewsets.ModelViewSet):
     http_method_names = ['get', 'post', 'put', 'delete']
     queryset = Password.objects.all()
     serializer_class = PasswordSerializer
+    pagination_class = ModifiedCursorPagination
     permission_classes_by_action = {'list': [CanListPassword, IsAuthenticated],
                                     'create': [CanCreatePassword, IsAuthenticated],
                                     'retrieve': [CanRetrievePassword, IsAuthenticated],
                                     'update': [CanUpdatePassword, IsAuthenticated],
-                                    'destroy': [CanDestroyPassword, IsAuthenticated]}
+                                    'destroy': [CanDestroyPassword, IsAuthenticated],
+                                    'reveal': [CanRetrievePassword, IsAuthenticated],
+                                    'reveal_many': [CanListPassword, IsAuthenticated],
+                                    'bulk': [CanListPassword, IsAuthenticated]}
 
+    def get_visible_queryset(self, request):
+        return self.get_queryset().visible_to(request.user)
+
+    # ?metadata=true lists passwords without loading or decrypting their secrets,
+    # ?fields= and ?exclude= load and serialize only the selected fields,
+    # ?stream=true writes every visible password as one JSON array, chunk by chunk, instead of a page
     def list(self, request, **kwargs):
         try:
-            queryset = self.get_queryset().filter(Q(folder_id__passwordfolderacl__user=request.user) |
-                                                  Q(folder__user=request.user, folder__personal=True))
-            serializer = PasswordSerializer(queryset, many=True, context={'request': request})
+            # unchanged since the client's copy: answer 304 before loading or decrypting anything
+            etag = list_etag(request, self.get_visible_queryset(request))
+            response = not_modified(request, etag)
+            if response is not None:
+                return response
+            if request.query_params.get('metadata', '').lower() in ('1', 'true'):
+                serializer_class = PasswordMetadataSerializer
+            else:
+                serializer_class = PasswordSerializer
+            fields = sparse_fields(request, serializer_class.Meta.fields)
+            columns = {'id', 'modified'} | set(fields) - {'password', 'tags'}
+            queryset = self.get_visible_queryset(request)
+            if 'password' in fields:
+                columns |= {'folder', 'password', 'secret', 'scheme', 'key_id'}
+                queryset = queryset.select_related('folder')
+            queryset = queryset.only(*columns)
+            if request.query_params.get('stream', '').lower() in ('1', 'true'):
+                prefetch = ['tags'] if 'tags' in fields else []
+                response = stream_json_list(
+                    iterate_chunks(queryset.order_by('id'), prefetch=prefetch),
+                    lambda chunk: serializer_class(chunk, many=True, context={'request': request}).data)
+                return set_validators(response, etag)
+            if 'tags' in fields:
+                # tags of the whole page in one query instead of one per password
+                queryset = queryset.prefetch_related('tags')
+            page = self.paginate_queryset(queryset)
+            serializer = serializer_class(page, many=True, context={'request': request})
+            data = serializer.data
+        except APIException:
+            # an invalid ?cursor= or ?page_size= answers with its own status
+            raise
         except:
             return Response(status=status.HTTP_500_INTERNAL_SERVER_ERROR)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return set_validators(self.get_paginated_response(data), etag)
+
+    @action(detail=True, methods=['get'])
+    def reveal(self, request, pk=None):
+        try:
+            instance = self.get_object()
+            serializer = PasswordSecretSerializer(instance, context={'request': request})
+            return Response(serializer.data, status=status.HTTP_200_OK)
+        except (Http404, InvalidToken, TypeError):
+            return Response(status=status.HTTP_404_NOT_FOUND)
+
+    # reveal the secrets of the visible passwords listed in `ids`
+    @action(detail=False, methods=['post'], url_path='reveal', url_name='reveal-many')
+    def reveal_many(self, request):
+        ids = request.data.get('ids')
+        if not isinstance(ids, list):
+            return Response({'ids': ['Expected a list of password ids.']}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            queryset = self.get_visible_queryset(request).filter(pk__in=ids).select_related('folder')
+            serializer = PasswordSecretSerializer(queryset, many=True, context={'request': request})
+            return Response(serializer.data, status=status.HTTP_200_OK)
+        except (InvalidToken, TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+    # {"create": [...], "update": [...], "delete": [ids]} in one transaction; folder rights are checked per item
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        try:
+            serializer = PasswordBulkSerializer(request.data, context={'request': request})
+            return Response(serializer.apply(), status=status.HTTP_200_OK)
+        except ValidationError as e:
+            return Response(e.detail, status=status.HTTP_400_BAD_REQUEST)
+        except (AttributeError, InvalidToken, TypeError, ValueError):
+            return Response(status=status.HTTP_400_BAD_REQUEST)
 
     def create(self, request, **kwargs):
         try:
@@ -94,6 +179,7 @@ class PasswordViewSet(viewsets.ModelViewSet):
 class PasswordACLViewSet(viewsets.ModelViewSet):
     queryset = PasswordACL.objects.all()
     serializer_class = PasswordACLSerializer
+    pagination_class = ModifiedCursorPagination
     permission_classes_by_action = {'list': [CanListPasswordACL],
                                     'create': [CanCreatePasswordACL],
                                     'retrieve': [CanRetrievePasswordACL],
@@ -102,14 +188,13 @@ class PasswordACLViewSet(viewsets.ModelViewSet):
 
     def list(self, request, **kwargs):
         try:
-            passwords = Password.objects.filter(passwordacl__in=self.get_queryset().filter(
-                user=request.user)
-            )
-            queryset = self.get_queryset().filter(password__in=passwords)
+            # the caller's own ACLs, and every ACL of passwords in folders they administer
+            folders = get_acl_folders(request, AccessLevel.ADMIN).values('id')
+            queryset = self.get_queryset().filter(Q(user=request.user) | Q(password__folder__in=folders))
         except TypeError:
-            queryset = None
-        serializer = PasswordACLSerializer(queryset, many=True, context={'request': request})
-        return Response(serializer.data, status=status.HTTP_200_OK)
+            queryset = PasswordACL.objects.none()
+        serializer = PasswordACLSerializer(self.paginate_queryset(queryset), many=True, context={'request': request})
+        return self.get_paginated_response(serializer.data)
 
     def create(self, request, **kwargs):
         try:
@@ -160,3 +245,7 @@ class PasswordACLViewSet(viewsets.ModelViewSet):
 class PasswordTypeViewSet(viewsets.ModelViewSet):
     queryset = PasswordType.objects.all()
     serializer_class = PasswordTypeSerializer
+
+    def list(self, request, **kwargs):
+        serializer = PasswordTypeSerializer(password_types.all(), many=True, context={'request': request})
+        return set_reference_cache(Response(serializer.data, status=status.HTTP_200_OK))